@@ -0,0 +1,29 @@
+"""add messages history index
+
+Revision ID: 4b3f35baa22d
+Revises: fb965ce070bc
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4b3f35baa22d'
+down_revision: Union[str, Sequence[str], None] = 'fb965ce070bc'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # История диалога: WHERE user_id = ? AND assistant_slug = ? ORDER BY id DESC
+    op.create_index('ix_messages_user_assistant_id', 'messages', ['user_id', 'assistant_slug', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_messages_user_assistant_id', table_name='messages')
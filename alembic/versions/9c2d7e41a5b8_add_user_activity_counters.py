@@ -0,0 +1,50 @@
+"""add user activity counters
+
+Revision ID: 9c2d7e41a5b8
+Revises: 4b3f35baa22d
+Create Date: 2026-10-17 13:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9c2d7e41a5b8'
+down_revision: Union[str, Sequence[str], None] = '4b3f35baa22d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('users', sa.Column('total_messages', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('users', sa.Column('last_message_at', sa.DateTime(), nullable=True))
+    op.add_column('users', sa.Column('clicks_count', sa.Integer(), nullable=False, server_default='0'))
+
+    # Backfill: один раз считаем счетчики по уже накопленным сообщениям и кликам.
+    # Дальше приложение ведет их само в транзакциях записи.
+    op.execute("""
+        UPDATE users SET
+            total_messages = (
+                SELECT count(*) FROM messages
+                WHERE messages.user_id = users.tg_id AND messages.role = 'user'
+            ),
+            last_message_at = (
+                SELECT max(messages.created_at) FROM messages
+                WHERE messages.user_id = users.tg_id AND messages.role = 'user'
+            ),
+            clicks_count = (
+                SELECT count(*) FROM user_clicks
+                WHERE user_clicks.user_id = users.tg_id
+            )
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('users', 'clicks_count')
+    op.drop_column('users', 'last_message_at')
+    op.drop_column('users', 'total_messages')
@@ -0,0 +1,50 @@
+"""add cohort tables
+
+Revision ID: a7f3c9e15d42
+Revises: d41e8a6f2c07
+Create Date: 2026-10-17 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a7f3c9e15d42'
+down_revision: Union[str, Sequence[str], None] = 'd41e8a6f2c07'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('user_cohorts',
+    sa.Column('user_id', sa.BigInteger(), nullable=False),
+    sa.Column('cohort_day', sa.Date(), nullable=False),
+    sa.Column('last_day_n', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+    op.create_index(op.f('ix_user_cohorts_cohort_day'), 'user_cohorts', ['cohort_day'], unique=False)
+    op.create_table('cohort_retention',
+    sa.Column('period', sa.String(), nullable=False),
+    sa.Column('cohort_start', sa.Date(), nullable=False),
+    sa.Column('n', sa.Integer(), nullable=False),
+    sa.Column('users', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('period', 'cohort_start', 'n')
+    )
+
+    # Когорты строятся тем же инкрементальным проходом, что и дневные агрегаты.
+    # Агрегаты — производные данные, поэтому сбрасываем их вместе с high-water mark:
+    # при следующем запуске приложение пересчитает все с начала истории.
+    op.execute("DELETE FROM daily_user_activity")
+    op.execute("DELETE FROM daily_assistant_stats")
+    op.execute("DELETE FROM rollup_state WHERE name = 'messages'")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('cohort_retention')
+    op.drop_index(op.f('ix_user_cohorts_cohort_day'), table_name='user_cohorts')
+    op.drop_table('user_cohorts')
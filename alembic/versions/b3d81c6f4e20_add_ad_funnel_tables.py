@@ -0,0 +1,56 @@
+"""add ad funnel tables
+
+Revision ID: b3d81c6f4e20
+Revises: e58b2f0d9a13
+Create Date: 2026-10-17 19:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b3d81c6f4e20'
+down_revision: Union[str, Sequence[str], None] = 'e58b2f0d9a13'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('user_clicks', sa.Column('assistant_slug', sa.String(), nullable=True))
+    op.create_table('ad_impressions',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.BigInteger(), nullable=True),
+    sa.Column('product_id', sa.Integer(), nullable=True),
+    sa.Column('assistant_slug', sa.String(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['product_id'], ['products.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.tg_id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_ad_impressions_user_product_time', 'ad_impressions', ['user_id', 'product_id', 'created_at'], unique=False)
+    op.create_table('daily_ad_stats',
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('product_id', sa.Integer(), nullable=False),
+    sa.Column('assistant_slug', sa.String(), nullable=False),
+    sa.Column('impressions', sa.Integer(), nullable=False),
+    sa.Column('clicks', sa.Integer(), nullable=False),
+    sa.Column('attributed_clicks', sa.Integer(), nullable=False),
+    sa.Column('latency_seconds', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('day', 'product_id', 'assistant_slug')
+    )
+    # Уже накопленные клики попадут в daily_ad_stats при первом проходе
+    # агрегации (high-water mark "user_clicks" начинается с нуля), без ассистента.
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('daily_ad_stats')
+    op.drop_index('ix_ad_impressions_user_product_time', table_name='ad_impressions')
+    op.drop_table('ad_impressions')
+    with op.batch_alter_table('user_clicks') as batch_op:
+        batch_op.drop_column('assistant_slug')
+    op.execute("DELETE FROM rollup_state WHERE name IN ('ad_impressions', 'user_clicks')")
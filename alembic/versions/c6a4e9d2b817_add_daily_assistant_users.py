@@ -0,0 +1,43 @@
+"""add daily assistant users
+
+Revision ID: c6a4e9d2b817
+Revises: b3d81c6f4e20
+Create Date: 2026-10-17 20:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c6a4e9d2b817'
+down_revision: Union[str, Sequence[str], None] = 'b3d81c6f4e20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('daily_assistant_users',
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('assistant_slug', sa.String(), nullable=False),
+    sa.Column('user_id', sa.BigInteger(), nullable=False),
+    sa.Column('message_count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('day', 'assistant_slug', 'user_id')
+    )
+
+    # Таблицу заполняет тот же инкрементальный проход по сообщениям:
+    # сбрасываем производные таблицы и high-water mark, как при добавлении скетчей.
+    op.execute("DELETE FROM daily_user_activity")
+    op.execute("DELETE FROM daily_assistant_stats")
+    op.execute("DELETE FROM daily_sketches")
+    op.execute("DELETE FROM cohort_retention")
+    op.execute("DELETE FROM user_cohorts")
+    op.execute("DELETE FROM rollup_state WHERE name = 'messages'")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('daily_assistant_users')
@@ -0,0 +1,48 @@
+"""add daily rollups
+
+Revision ID: d41e8a6f2c07
+Revises: 9c2d7e41a5b8
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd41e8a6f2c07'
+down_revision: Union[str, Sequence[str], None] = '9c2d7e41a5b8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Таблицы пустые: app/rollups.py заполнит их при первом запуске, начиная с last_id = 0
+    op.create_table('daily_user_activity',
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('user_id', sa.BigInteger(), nullable=False),
+    sa.Column('message_count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('day', 'user_id')
+    )
+    op.create_table('daily_assistant_stats',
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('assistant_slug', sa.String(), nullable=False),
+    sa.Column('message_count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('day', 'assistant_slug')
+    )
+    op.create_table('rollup_state',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('last_id', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('rollup_state')
+    op.drop_table('daily_assistant_stats')
+    op.drop_table('daily_user_activity')
@@ -0,0 +1,43 @@
+"""add daily sketches
+
+Revision ID: e58b2f0d9a13
+Revises: a7f3c9e15d42
+Create Date: 2026-10-17 17:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e58b2f0d9a13'
+down_revision: Union[str, Sequence[str], None] = 'a7f3c9e15d42'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('daily_sketches',
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('scope', sa.String(), nullable=False),
+    sa.Column('registers', sa.LargeBinary(), nullable=False),
+    sa.PrimaryKeyConstraint('day', 'scope')
+    )
+
+    # Скетчи заполняет тот же инкрементальный проход по сообщениям.
+    # Сбрасываем все производные таблицы вместе с high-water mark, чтобы
+    # приложение пересчитало их с начала истории (когорты тоже: иначе
+    # повторный проход посчитал бы удержание дважды).
+    op.execute("DELETE FROM daily_user_activity")
+    op.execute("DELETE FROM daily_assistant_stats")
+    op.execute("DELETE FROM cohort_retention")
+    op.execute("DELETE FROM user_cohorts")
+    op.execute("DELETE FROM rollup_state WHERE name = 'messages'")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('daily_sketches')
@@ -0,0 +1,36 @@
+import asyncio
+
+# Маркер остановки фоновой задачи: кладется в очередь последним, все перед ним дописывается
+STOP = object()
+
+async def collect_batch(queue: asyncio.Queue, window: float, max_batch: int) -> tuple[list, bool]:
+    """
+    Пачка из очереди для фоновых писателей (app/writes.py, app/clicks.py).
+
+    Ждет первый элемент, затем добирает пачку в пределах окна window секунд,
+    но не больше max_batch. Все, что уже накопилось в очереди, забирается
+    без ожидания. Возвращает (пачка, пора_остановиться): STOP завершает
+    пачку, а элементы перед ним в нее попадают.
+    """
+    item = await queue.get()
+    if item is STOP:
+        return [], True
+    batch = [item]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + window
+    while len(batch) < max_batch:
+        if queue.empty():
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+        else:
+            # Все, что накопилось, пока шла предыдущая запись, забираем без ожидания
+            item = queue.get_nowait()
+        if item is STOP:
+            return batch, True
+        batch.append(item)
+    return batch, False
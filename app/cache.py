@@ -0,0 +1,52 @@
+import asyncio
+import time
+
+class VersionedCache:
+    """
+    База для справочников, которые целиком живут в памяти процесса
+    (каталог товаров, реестр ассистентов).
+
+    Наследник реализует load() — прочитать данные из БД и подменить
+    свое состояние. Кэш пересобирается при первом обращении после
+    invalidate() (правки в админке, sync_google) или по TTL — на случай,
+    если приложение запущено в несколько воркеров.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.version = 0
+        self._loaded_at = 0.0
+        self._stale = True
+        self._lock = asyncio.Lock()
+
+    async def load(self):
+        raise NotImplementedError
+
+    def invalidate(self):
+        """Помечает кэш устаревшим. Пересборка произойдет при следующем обращении."""
+        self._stale = True
+
+    def _is_fresh(self) -> bool:
+        if self._stale:
+            return False
+        return not self.ttl or time.monotonic() - self._loaded_at < self.ttl
+
+    async def reload(self):
+        # Сначала сбрасываем флаг: если во время загрузки пришел invalidate(),
+        # он снова пометит кэш устаревшим и правка не потеряется.
+        self._stale = False
+        try:
+            await self.load()
+        except Exception:
+            self._stale = True
+            raise
+        self._loaded_at = time.monotonic()
+        self.version += 1
+
+    async def ensure_loaded(self):
+        if self._is_fresh():
+            return
+        async with self._lock:
+            # Пока ждали блокировку, кэш мог пересобрать другой запрос
+            if not self._is_fresh():
+                await self.reload()
@@ -0,0 +1,97 @@
+import re
+from dataclasses import dataclass
+from sqlalchemy.future import select
+from app.config import settings
+from app.database import ReadSessionLocal
+from app.cache import VersionedCache
+from app.models import Product
+from app.relevance import RelevanceIndex
+
+@dataclass(frozen=True)
+class CatalogProduct:
+    """
+    Снимок товара для кэша. Не привязан к сессии SQLAlchemy,
+    поэтому безопасно живет между запросами.
+    """
+    id: int
+    name: str
+    keywords: str
+    ad_text: str
+    link: str
+
+def parse_target_assistants(value: str | None) -> list[str]:
+    """
+    "medic, fitness" -> ["medic", "fitness"].
+    Пустое поле означает "товар для всех ассистентов".
+    """
+    if not value:
+        return []
+    return [slug for slug in re.split(r"[,;\s]+", value) if slug]
+
+class ProductCatalog(VersionedCache):
+    """
+    Версионированный кэш активных товаров в памяти процесса.
+
+    При загрузке строится таблица slug ассистента -> кортеж разрешенных товаров,
+    так что get_products() отвечает за O(1) без запроса в БД,
+    и индекс релевантности по ключевым словам (см. app/relevance.py).
+    Кэш сбрасывается через invalidate() (правки в ProductAdmin, sync_google)
+    и, на случай нескольких воркеров, по TTL.
+    """
+
+    def __init__(self, ttl: int):
+        super().__init__(ttl)
+        self._common: tuple[CatalogProduct, ...] = ()
+        self._by_assistant: dict[str, tuple[CatalogProduct, ...]] = {}
+        self.index = RelevanceIndex(())
+        self._links: dict[int, str] = {}
+
+    async def load(self):
+        async with ReadSessionLocal() as session:
+            result = await session.execute(
+                select(Product).where(Product.is_active == True).order_by(Product.id)
+            )
+            products = result.scalars().all()
+
+        self._build(products)
+
+    def _build(self, products):
+        entries = []
+        slugs = set()
+        for p in products:
+            targets = parse_target_assistants(p.target_assistants)
+            slugs.update(targets)
+            entries.append((
+                CatalogProduct(id=p.id, name=p.name, keywords=p.keywords or "", ad_text=p.ad_text or "", link=p.link),
+                targets
+            ))
+
+        common = []
+        by_assistant = {slug: [] for slug in slugs}
+        for product, targets in entries:
+            if not targets:
+                # Товар для всех: попадает в каждую таблицу
+                common.append(product)
+                for bucket in by_assistant.values():
+                    bucket.append(product)
+            else:
+                for slug in targets:
+                    by_assistant[slug].append(product)
+
+        # Подменяем ссылки целиком, чтобы читатели не видели полусобранное состояние
+        self._common = tuple(common)
+        self._by_assistant = {slug: tuple(bucket) for slug, bucket in by_assistant.items()}
+        self.index = RelevanceIndex([product for product, _ in entries])
+        self._links = {product.id: product.link for product, _ in entries}
+
+    async def get_products(self, assistant_slug: str) -> tuple[CatalogProduct, ...]:
+        """Товары, разрешенные для ассистента (в порядке id)."""
+        await self.ensure_loaded()
+        return self._by_assistant.get(assistant_slug, self._common)
+
+    async def get_link(self, product_id: int) -> str | None:
+        """Целевая ссылка активного товара для редиректа /api/click."""
+        await self.ensure_loaded()
+        return self._links.get(product_id)
+
+product_catalog = ProductCatalog(ttl=settings.PRODUCT_CATALOG_TTL)
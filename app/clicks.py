@@ -0,0 +1,110 @@
+import asyncio
+from sqlalchemy import insert, select
+from app.batching import STOP, collect_batch
+from app.config import settings
+from app.writes import write_coordinator
+from app.models import User, UserClick, AdImpression, get_current_time
+from app.counters import increment_user_clicks
+
+class EventQueue:
+    """
+    Очередь событий с пакетной записью в таблицу table.
+
+    Обработчик запроса только кладет событие в очередь и идет дальше,
+    а фоновая задача вставляет накопленные события одним INSERT'ом
+    (до batch_size строк, ожидая добор не дольше flush_interval секунд).
+    """
+
+    table = None
+    label = "event"
+
+    def __init__(self, batch_size: int, flush_interval: float, max_size: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+        self._task: asyncio.Task | None = None
+        self.dropped = 0
+
+    def put(self, **event):
+        # Время фиксируем в момент события, а не в момент записи пачки
+        event.setdefault("created_at", get_current_time())
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Лучше потерять событие, чем задержать ответ пользователю
+            self.dropped += 1
+            print(f"{self.label.capitalize()} queue is full, {self.label} dropped ({event})")
+
+    def _drain(self) -> list[dict]:
+        batch = []
+        while not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _insert(self, conn, batch: list[dict]):
+        await conn.execute(insert(self.table), batch)
+
+    async def _write(self, batch: list[dict]):
+        try:
+            # Пачка событий — одно намерение записи; коммитится вместе с остальными записями
+            await write_coordinator.submit(lambda conn: self._insert(conn, batch))
+        except Exception as e:
+            print(f"{self.label.capitalize()} batch insert error ({len(batch)} {self.label}s): {e}")
+
+    async def _run(self):
+        while True:
+            batch, stopping = await collect_batch(self._queue, self.flush_interval, self.batch_size)
+            if batch:
+                await self._write(batch)
+            if stopping:
+                return
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую задачу и дописывает все, что осталось в очереди."""
+        if self._task is not None:
+            # Маркер встает в конец очереди: задача допишет все события перед ним
+            await self._queue.put(STOP)
+            await self._task
+            self._task = None
+        batch = self._drain()
+        for start in range(0, len(batch), self.batch_size):
+            await self._write(batch[start:start + self.batch_size])
+
+class ClickQueue(EventQueue):
+    """Персональные клики (UserClick): /api/click ставит клик в очередь и сразу отдает редирект."""
+
+    table = UserClick.__table__
+    label = "click"
+
+    async def _insert(self, conn, batch: list[dict]):
+        # user_id приходит из ссылки (/api/click?user_id=...). Неизвестного пользователя
+        # клик не сохраняет: внешний ключ на users.tg_id (PostgreSQL его проверяет)
+        # отклонил бы всю пачку. Сам клик по товару остается в статистике.
+        user_ids = {click["user_id"] for click in batch if click.get("user_id") is not None}
+        known = set((await conn.execute(select(User.tg_id).where(User.tg_id.in_(user_ids)))).scalars()) if user_ids else set()
+        batch = [click if click.get("user_id") in known else {**click, "user_id": None} for click in batch]
+        await super()._insert(conn, batch)
+        # users.clicks_count — в той же транзакции, что и сами клики
+        await increment_user_clicks(conn, [click for click in batch if click["user_id"] is not None])
+
+class ImpressionQueue(EventQueue):
+    """Журнал показов рекламы (AdImpression): пишется после ответа ассистента."""
+
+    table = AdImpression.__table__
+    label = "impression"
+
+click_queue = ClickQueue(
+    batch_size=settings.CLICKS_BATCH_SIZE,
+    flush_interval=settings.CLICKS_FLUSH_INTERVAL,
+    max_size=settings.CLICKS_QUEUE_SIZE,
+)
+
+impression_queue = ImpressionQueue(
+    batch_size=settings.CLICKS_BATCH_SIZE,
+    flush_interval=settings.CLICKS_FLUSH_INTERVAL,
+    max_size=settings.CLICKS_QUEUE_SIZE,
+)
@@ -17,9 +17,97 @@ class Settings(BaseSettings):
     REDIRECT_BASE_URL: str = "http://localhost:8000"
     OPENROUTER_BASE_URL: str = "https://openrouter.ai/api/v1"
     CHAT_HISTORY_LIMIT: int = 10
+    # Кэш окон переписки в памяти: максимум диалогов и суммарная длина текста (символов)
+    HISTORY_CACHE_MAX_CONVERSATIONS: int = 5000
+    HISTORY_CACHE_MAX_CHARS: int = 20_000_000
+    # Сверять окно из кэша с id последних сообщений в БД (чтение по индексу, без текстов).
+    # Включайте, если воркеров uvicorn больше одного: другие воркеры пишут в диалог мимо кэша
+    # этого процесса. При одном воркере кэш точен и попадание не читает БД вовсе
+    HISTORY_CACHE_VALIDATE: bool = False
+
+    # Реклама: сколько самых релевантных товаров отдавать в промпт (0 = все разрешенные)
+    AD_TOP_K: int = 3
+    # Порог совпадения товара с запросом (app/relevance.py): доля от максимума для термина,
+    # сумма по терминам. Ключевое слово из текущего сообщения дает ~0.6, слово рекламного
+    # текста ~0.45, ключевое слово только из истории ~0.3
+    AD_MIN_SCORE: float = 0.3
+
+    # Кэши (секунды). TTL страхует, если приложение запущено в несколько воркеров
+    PRODUCT_CATALOG_TTL: int = 300
+    ASSISTANT_REGISTRY_TTL: int = 300
+
+    # Дашборд админки: результат свежий ttl секунд; до stale_ttl отдается старый,
+    # пока в фоне считается новый
+    DASHBOARD_CACHE_TTL: float = 30.0
+    DASHBOARD_STALE_TTL: float = 600.0
+    # Уникальные пользователи (DAU/WAU/MAU, по ассистентам): "exact" — COUNT DISTINCT,
+    # "approx" — объединение дневных HyperLogLog-скетчей (ошибка ~0.8%)
+    DASHBOARD_UNIQUES_MODE: str = "exact"
+    # Дневные агрегаты для дашборда: как часто догонять новые сообщения и каким шагом
+    ROLLUP_INTERVAL: float = 60.0
+    ROLLUP_CHUNK_SIZE: int = 5000
+    # PostgreSQL: id из последовательности могут закоммититься не по порядку, поэтому
+    # агрегация берет только события старше N секунд (см. IncrementalRollup)
+    ROLLUP_SETTLE_SECONDS: float = 30.0
+
+    # Счетчики показов/кликов пишутся в БД пачками: раз в N секунд или по накоплению
+    COUNTERS_FLUSH_INTERVAL: float = 5.0
+    COUNTERS_FLUSH_THRESHOLD: int = 100
+
+    # Запись в БД идет через одного писателя с групповым коммитом (app/writes.py):
+    # сколько ждать добора пачки (секунды; 0 — только то, что накопилось за прошлый коммит),
+    # максимум намерений в пачке и длина очереди
+    WRITE_BATCH_WINDOW: float = 0.005
+    WRITE_BATCH_MAX: int = 500
+    WRITE_QUEUE_SIZE: int = 10000
+
+    # Клики пользователей и показы рекламы пишутся пачками из очередей в памяти
+    CLICKS_BATCH_SIZE: int = 200
+    CLICKS_FLUSH_INTERVAL: float = 1.0
+    CLICKS_QUEUE_SIZE: int = 10000
+    # Клик засчитывается показу того же товара тому же пользователю не старше N секунд
+    AD_ATTRIBUTION_WINDOW: int = 7 * 24 * 3600
+
+    # Логировать каждый SQL-запрос (echo SQLAlchemy) — только для отладки
+    DB_ECHO: bool = False
+    # Учет SQL по запросам (app/sqlstats.py): порог медленного запроса (мс), сколько
+    # повторов одного запроса за HTTP-запрос считать N+1, сколько последних запросов
+    # эндпоинта держать в сводке и отдавать ли X-SQL-* заголовки в ответах
+    SQL_SLOW_QUERY_MS: float = 200.0
+    SQL_N_PLUS_ONE_THRESHOLD: int = 10
+    SQL_STATS_WINDOW: int = 500
+    SQL_DEBUG_HEADERS: bool = False
+
+    # Пул соединений PostgreSQL на один воркер uvicorn. Дашборд считает 9 групп метрик
+    # параллельно, чат держит 1-2 соединения; воркеров x (size + overflow) должно
+    # укладываться в max_connections сервера (по умолчанию 100)
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 5
+    DB_POOL_TIMEOUT: float = 10.0
+    DB_POOL_RECYCLE: int = 1800
+
+    # SQLite: "production" — WAL, synchronous=NORMAL, mmap и кэш страниц (app/database.py)
+    # и отдельный пул соединений только для чтения; "default" — настройки SQLite по умолчанию
+    SQLITE_PROFILE: str = "production"
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
+    # Отрицательное значение — размер в КиБ (64 МБ на соединение)
+    SQLITE_CACHE_SIZE: int = -64_000
+    SQLITE_JOURNAL_SIZE_LIMIT: int = 64 * 1024 * 1024
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    READ_POOL_SIZE: int = 10
+    READ_POOL_OVERFLOW: int = 10
 
     # Paths
     UPLOAD_DIR: str = "static/uploads"
+
+    # Обработка картинок: пул воркеров ("thread" или "process"),
+    # сколько картинок может ждать в очереди и таймаут на одну (секунды)
+    IMAGE_POOL_KIND: str = "thread"
+    IMAGE_POOL_WORKERS: int = 2
+    IMAGE_QUEUE_DEPTH: int = 8
+    IMAGE_TIMEOUT: float = 15.0
+    # Максимальный размер загружаемого файла (байты)
+    MAX_UPLOAD_BYTES: int = 15 * 1024 * 1024
     
     # Admins
     ADMIN_IDS: str = "12346,254913192"
@@ -29,6 +117,12 @@ class Settings(BaseSettings):
     # Salebot
     SALEBOT_API_KEY: str = ""
     SALEBOT_TARGET_BLOCK_ID: str = "12345678"
+    SALEBOT_TIMEOUT: float = 10.0
+    # Поиск Salebot ID: запросы за окно (секунды) склеиваются в один load_clients
+    SALEBOT_BATCH_WINDOW: float = 0.05
+    SALEBOT_BATCH_SIZE: int = 50
+    # Сколько секунд не переспрашивать Salebot о пользователе, которого он не знает
+    SALEBOT_NEGATIVE_TTL: int = 3600
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,151 @@
+import asyncio
+from collections import Counter, defaultdict
+from sqlalchemy import update, select, bindparam, func
+from app.config import settings
+from app.writes import write_coordinator
+from app.models import Product, User, Message, UserClick
+
+products_table = Product.__table__
+users_table = User.__table__
+
+# Атомарный инкремент: UPDATE products SET impressions = impressions + :n ...
+_increment_stmt = (
+    update(products_table)
+    .where(products_table.c.id == bindparam("pid"))
+    .values(
+        impressions=func.coalesce(products_table.c.impressions, 0) + bindparam("d_impressions"),
+        clicks=func.coalesce(products_table.c.clicks, 0) + bindparam("d_clicks"),
+    )
+)
+
+class ProductCounters:
+    """
+    Буфер показов/кликов товаров (write-behind).
+
+    Запросы только копят дельты в памяти, а фоновая задача раз в
+    flush_interval секунд (или раньше, если накопилось flush_threshold
+    событий) пишет их одним пакетом атомарных UPDATE ... SET x = x + :n.
+    Так в горячем пути нет чтения товара и конкурирующих апдейтов строки,
+    а инкременты не теряются при параллельных запросах.
+    """
+
+    def __init__(self, flush_interval: float, flush_threshold: int):
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._pending: dict[int, list[int]] = defaultdict(lambda: [0, 0])  # pid -> [impressions, clicks]
+        self._events = 0
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+
+    def add_impression(self, product_id: int, n: int = 1):
+        self._add(product_id, 0, n)
+
+    def add_click(self, product_id: int, n: int = 1):
+        self._add(product_id, 1, n)
+
+    def _add(self, product_id: int, column: int, n: int):
+        self._pending[product_id][column] += n
+        self._events += n
+        if self._events >= self.flush_threshold:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            # Забираем накопленное целиком; новые события пойдут в свежий буфер
+            batch, self._pending = self._pending, defaultdict(lambda: [0, 0])
+            self._events = 0
+
+            rows = [
+                {"pid": pid, "d_impressions": d_impressions, "d_clicks": d_clicks}
+                for pid, (d_impressions, d_clicks) in batch.items()
+            ]
+            try:
+                await write_coordinator.submit(lambda conn: conn.execute(_increment_stmt, rows))
+            except Exception as e:
+                print(f"Counters flush error: {e}")
+                # Возвращаем дельты в буфер, чтобы записать их по следующему таймеру
+                for pid, (d_impressions, d_clicks) in batch.items():
+                    pending = self._pending[pid]
+                    pending[0] += d_impressions
+                    pending[1] += d_clicks
+                    self._events += d_impressions + d_clicks
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую задачу и сбрасывает остаток буфера в БД."""
+        if self._task is not None:
+            # Не отменяем задачу: даем ей дописать текущий пакет
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+# --- Счетчики активности пользователя (users.total_messages, last_message_at, clicks_count) ---
+# Хранятся в самой строке users и обновляются в той же транзакции,
+# что и INSERT сообщений/кликов, поэтому не расходятся с таблицами событий.
+
+_user_clicks_stmt = (
+    update(users_table)
+    .where(users_table.c.tg_id == bindparam("uid"))
+    .values(clicks_count=users_table.c.clicks_count + bindparam("n"))
+)
+
+def increment_user_messages(user_id: int, sent_at):
+    """UPDATE счетчиков после сообщения пользователя (выполнять в транзакции INSERT'а)."""
+    return (
+        update(users_table)
+        .where(users_table.c.tg_id == user_id)
+        .values(total_messages=users_table.c.total_messages + 1, last_message_at=sent_at)
+    )
+
+async def increment_user_clicks(conn, clicks: list[dict]):
+    """Добавляет пачку кликов к users.clicks_count (одним executemany)."""
+    per_user = Counter(click["user_id"] for click in clicks)
+    if per_user:
+        await conn.execute(_user_clicks_stmt, [{"uid": uid, "n": n} for uid, n in per_user.items()])
+
+def recount_user_activity(user_id: int):
+    """
+    Пересчет счетчиков пользователя по таблицам событий.
+    Нужен, когда события удаляют (админка), — инкрементом это не выразить.
+    """
+    user_messages = (Message.user_id == user_id) & (Message.role == "user")
+    return (
+        update(users_table)
+        .where(users_table.c.tg_id == user_id)
+        .values(
+            total_messages=select(func.count(Message.id)).where(user_messages).scalar_subquery(),
+            last_message_at=select(func.max(Message.created_at)).where(user_messages).scalar_subquery(),
+            clicks_count=select(func.count(UserClick.id)).where(UserClick.user_id == user_id).scalar_subquery(),
+        )
+    )
+
+async def refresh_user_activity(user_id: int):
+    try:
+        await write_coordinator.submit(lambda conn: conn.execute(recount_user_activity(user_id)))
+    except Exception as e:
+        print(f"User activity recount error (user={user_id}): {e}")
+
+product_counters = ProductCounters(
+    flush_interval=settings.COUNTERS_FLUSH_INTERVAL,
+    flush_threshold=settings.COUNTERS_FLUSH_THRESHOLD,
+)
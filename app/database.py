@@ -1,17 +1,118 @@
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.dialects import sqlite, postgresql
 from sqlalchemy.orm import sessionmaker, declarative_base
 from app.config import settings
+from app.sqlstats import sql_stats
+
+SQLITE_PROFILES = ("production", "default")
+
+def engine_options(url: str) -> dict:
+    """Параметры create_async_engine под диалект DATABASE_URL."""
+    backend = make_url(url).get_backend_name()
+    if backend == "sqlite":
+        # ВАЖНО: check_same_thread=False нужен для SQLite в асинхронном режиме
+        return {"connect_args": {"check_same_thread": False}}
+    if backend == "postgresql":
+        return {
+            "pool_size": settings.DB_POOL_SIZE,
+            "max_overflow": settings.DB_MAX_OVERFLOW,
+            "pool_timeout": settings.DB_POOL_TIMEOUT,
+            # Соединения, закрытые сервером (рестарт, idle timeout), отбраковываются до выдачи
+            "pool_pre_ping": True,
+            "pool_recycle": settings.DB_POOL_RECYCLE,
+        }
+    return {}
+
+def is_sqlite_file(url: str) -> bool:
+    """SQLite-база в файле (у :memory: каждое соединение видит свою базу)."""
+    parsed = make_url(url)
+    return parsed.get_backend_name() == "sqlite" and parsed.database not in (None, "", ":memory:")
+
+def sqlite_pragmas(read_only: bool) -> list[str]:
+    """PRAGMA, которые выполняются на каждом новом соединении в профиле "production"."""
+    pragmas = [
+        f"PRAGMA busy_timeout={settings.SQLITE_BUSY_TIMEOUT_MS}",
+        # WAL: читатели не блокируют писателя и не ждут его коммита. Режим хранится
+        # в файле базы; включает его то соединение, что открылось первым (хоть читающее)
+        "PRAGMA journal_mode=WAL",
+        # В WAL NORMAL не fsync-ит каждый коммит (только при checkpoint) и не рискует целостностью
+        "PRAGMA synchronous=NORMAL",
+        f"PRAGMA mmap_size={settings.SQLITE_MMAP_SIZE}",
+        f"PRAGMA cache_size={settings.SQLITE_CACHE_SIZE}",
+        # После checkpoint WAL-файл обрезается до этого размера (иначе остается размером с самую большую транзакцию)
+        f"PRAGMA journal_size_limit={settings.SQLITE_JOURNAL_SIZE_LIMIT}",
+        "PRAGMA temp_store=MEMORY",
+    ]
+    if read_only:
+        pragmas.append("PRAGMA query_only=ON")
+    return pragmas
+
+def apply_sqlite_profile(engine, read_only: bool = False):
+    """Вешает PRAGMA профиля на событие connect синхронного движка под async-оберткой."""
+    pragmas = sqlite_pragmas(read_only)
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+if settings.SQLITE_PROFILE not in SQLITE_PROFILES:
+    raise ValueError(f"Unknown SQLite profile: {settings.SQLITE_PROFILE}")
 
-# ВАЖНО: check_same_thread=False нужен для SQLite в асинхронном режиме
 engine = create_async_engine(
     settings.DATABASE_URL, 
-    echo=True,
-    connect_args={"check_same_thread": False} 
+    echo=settings.DB_ECHO,
+    **engine_options(settings.DATABASE_URL),
 )
 
+# Отдельный пул только для чтения (история, дашборд, кэши каталога и ассистентов):
+# в WAL читатели идут параллельно писателю и не занимают соединения, нужные записи.
+# Для :memory:, профиля "default" и PostgreSQL (там читатели и так не блокируют
+# писателей) чтение идет через основной движок.
+if settings.SQLITE_PROFILE == "production" and is_sqlite_file(settings.DATABASE_URL):
+    apply_sqlite_profile(engine)
+    read_engine = create_async_engine(
+        settings.DATABASE_URL,
+        echo=settings.DB_ECHO,
+        pool_size=settings.READ_POOL_SIZE,
+        max_overflow=settings.READ_POOL_OVERFLOW,
+        **engine_options(settings.DATABASE_URL),
+    )
+    apply_sqlite_profile(read_engine, read_only=True)
+else:
+    read_engine = engine
+
+# Число и время SQL по HTTP-запросам, медленные запросы и N+1 (вместо echo)
+sql_stats.instrument(engine)
+if read_engine is not engine:
+    sql_stats.instrument(read_engine)
+
 AsyncSessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+ReadSessionLocal = sessionmaker(read_engine, class_=AsyncSession, expire_on_commit=False)
 Base = declarative_base()
 
 async def get_db():
     async with AsyncSessionLocal() as session:
-        yield session
\ No newline at end of file
+        yield session
+
+async def get_read_db():
+    """Сессия для эндпоинтов, которые только читают."""
+    async with ReadSessionLocal() as session:
+        yield session
+
+async def dispose_engines():
+    await engine.dispose()
+    if read_engine is not engine:
+        await read_engine.dispose()
+
+def dialect_insert(conn, table):
+    """INSERT с поддержкой ON CONFLICT: у SQLite и PostgreSQL синтаксис один, но конструкция своя."""
+    if conn.dialect.name == "sqlite":
+        return sqlite.insert(table)
+    if conn.dialect.name == "postgresql":
+        return postgresql.insert(table)
+    raise NotImplementedError(f"Upsert is not supported for {conn.dialect.name}")
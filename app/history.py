@@ -0,0 +1,196 @@
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from sqlalchemy.future import select
+from app.config import settings
+from app.models import Message
+
+# По этой подстроке в ответе ассистента видно, что в нем уже была реклама
+AD_LINK_MARKER = "/api/click"
+
+@dataclass(frozen=True)
+class HistoryEntry:
+    """Сообщение из окна переписки: только то, что уходит в запрос к ИИ."""
+    role: str
+    content: str
+
+    @property
+    def has_ad(self) -> bool:
+        return self.role == "assistant" and AD_LINK_MARKER in self.content
+
+@dataclass(frozen=True)
+class History:
+    """
+    Снимок окна переписки на момент запроса.
+    has_recent_ad — была ли реклама в окне (считается при добавлении, а не сканированием).
+    """
+    messages: tuple[HistoryEntry, ...]
+    has_recent_ad: bool
+
+class ConversationWindow:
+    """
+    Последние limit сообщений одного диалога (пользователь + ассистент).
+    ids — id этих сообщений в БД, по ним окно сверяется с messages.
+    """
+
+    __slots__ = ("entries", "ids", "ad_count", "chars")
+
+    def __init__(self, limit: int):
+        self.entries: deque[HistoryEntry] = deque(maxlen=limit)
+        self.ids: deque[int] = deque(maxlen=limit)
+        self.ad_count = 0
+        self.chars = 0
+
+    def append(self, message_id: int, entry: HistoryEntry):
+        if len(self.entries) == self.entries.maxlen:
+            # deque сам вытолкнет самое старое сообщение — учитываем его заранее
+            dropped = self.entries[0]
+            self.ad_count -= dropped.has_ad
+            self.chars -= len(dropped.content)
+        self.entries.append(entry)
+        self.ids.append(message_id)
+        self.ad_count += entry.has_ad
+        self.chars += len(entry.content)
+
+    def snapshot(self) -> History:
+        return History(messages=tuple(self.entries), has_recent_ad=self.ad_count > 0)
+
+class ConversationCache:
+    """
+    LRU-кэш окон переписки по ключу (user_id, assistant_slug).
+
+    Активный диалог не читает историю из БД: окно заполняется из messages
+    один раз (промах), а дальше дополняется в save_messages после коммита.
+    Память ограничена числом диалогов и суммарной длиной текста;
+    при превышении вытесняются давно не использованные диалоги.
+
+    Кэш у каждого воркера uvicorn свой, а сообщения того же диалога может
+    сохранить другой воркер (или удалить админка в другом процессе). Поэтому
+    при нескольких воркерах нужен validate (HISTORY_CACHE_VALIDATE): окно
+    из кэша сверяется с id последних limit сообщений в БД (короткое чтение
+    только по индексу ix_messages_user_assistant_id, без текстов); если они
+    разошлись, окно перечитывается целиком. При одном воркере проверка
+    выключена, и попадание в кэш не обращается к БД.
+    """
+
+    def __init__(self, limit: int, max_conversations: int, max_chars: int, validate: bool = False):
+        self.limit = limit
+        self.max_conversations = max_conversations
+        self.max_chars = max_chars
+        self.validate = validate
+        self._windows: OrderedDict[tuple[int, str], ConversationWindow] = OrderedDict()
+        # Ключи, которые сейчас грузятся из БД: [сколько загрузок идет, были ли записи во время загрузки].
+        # Загрузок одного диалога может идти несколько (параллельные запросы одного пользователя)
+        self._loading: dict[tuple[int, str], list] = {}
+        self.chars = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    async def get(self, session, user_id: int, assistant_slug: str) -> History:
+        key = (user_id, assistant_slug)
+        window = self._windows.get(key)
+        if window is not None and self.validate:
+            result = await session.execute(
+                select(Message.id)
+                .where(Message.user_id == user_id, Message.assistant_slug == assistant_slug)
+                .order_by(Message.id.desc())
+                .limit(self.limit)
+            )
+            ids = result.scalars().all()
+            # Окно могли заменить, пока шло чтение, — сверяем то, что в кэше сейчас
+            window = self._windows.get(key)
+            if window is not None and list(window.ids) != ids[::-1]:
+                # Диалог менялся мимо этого воркера
+                self.stale += 1
+                self.invalidate(user_id, assistant_slug)
+                window = None
+        if window is not None:
+            self.hits += 1
+            self._windows.move_to_end(key)
+            return window.snapshot()
+
+        self.misses += 1
+        loading = self._loading.setdefault(key, [0, False])
+        loading[0] += 1
+        try:
+            result = await session.execute(
+                select(Message.id, Message.role, Message.content)
+                .where(Message.user_id == user_id, Message.assistant_slug == assistant_slug)
+                .order_by(Message.id.desc())
+                .limit(self.limit)
+            )
+            rows = result.all()
+        finally:
+            loading[0] -= 1
+            written = loading[1]
+            if not loading[0]:
+                del self._loading[key]
+
+        window = ConversationWindow(self.limit)
+        for message_id, role, content in reversed(rows):
+            window.append(message_id, HistoryEntry(role=role, content=content or ""))
+
+        # Если пока шел SELECT по этому диалогу сохранили сообщения, прочитанное
+        # окно может их не содержать — отдаем его, но в кэш не кладем
+        if not written and key not in self._windows:
+            self._windows[key] = window
+            self.chars += window.chars
+            self._evict()
+        return window.snapshot()
+
+    def append(self, user_id: int, assistant_slug: str, ids: list[int], entries: list[HistoryEntry]):
+        """Дописывает сохраненные (уже закоммиченные) сообщения с их id в окно, если оно в кэше."""
+        key = (user_id, assistant_slug)
+        if key in self._loading:
+            self._loading[key][1] = True
+        window = self._windows.get(key)
+        if window is None:
+            return
+        self.chars -= window.chars
+        for message_id, entry in zip(ids, entries):
+            window.append(message_id, entry)
+        self.chars += window.chars
+        self._windows.move_to_end(key)
+        self._evict()
+
+    def _evict(self):
+        while self._windows and (len(self._windows) > self.max_conversations or self.chars > self.max_chars):
+            _, window = self._windows.popitem(last=False)
+            self.chars -= window.chars
+            self.evictions += 1
+
+    def invalidate(self, user_id: int, assistant_slug: str):
+        """Выбрасывает окно диалога (после удаления сообщений в админке)."""
+        key = (user_id, assistant_slug)
+        if key in self._loading:
+            self._loading[key][1] = True
+        window = self._windows.pop(key, None)
+        if window is not None:
+            self.chars -= window.chars
+
+    def invalidate_user(self, user_id: int):
+        for key in [key for key in self._windows if key[0] == user_id]:
+            self.invalidate(*key)
+        for key, loading in self._loading.items():
+            if key[0] == user_id:
+                loading[1] = True
+
+    def snapshot(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "conversations": len(self._windows),
+            "chars": self.chars,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total * 100, 1) if total else 0.0,
+        }
+
+conversation_cache = ConversationCache(
+    limit=settings.CHAT_HISTORY_LIMIT,
+    max_conversations=settings.HISTORY_CACHE_MAX_CONVERSATIONS,
+    max_chars=settings.HISTORY_CACHE_MAX_CHARS,
+    validate=settings.HISTORY_CACHE_VALIDATE,
+)
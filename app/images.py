@@ -0,0 +1,250 @@
+import asyncio
+import io
+import os
+import time
+import uuid
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse
+from PIL import Image, UnidentifiedImageError
+from app.config import settings
+
+# Картинки ужимаем до 1024px по широкой стороне и сохраняем в JPEG 70%
+MAX_SIZE = (1024, 1024)
+JPEG_QUALITY = 70
+# Результат draft-декодирования может быть чуть меньше 1024px (до 90%),
+# если это позволяет распаковать JPEG еще вдвое мельче
+DRAFT_TOLERANCE = 0.9
+
+STAGES = ("decode", "resize", "encode")
+
+# Загрузку читаем кусками, чтобы не держать лишнего сверх лимита
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+async def read_upload(file: UploadFile, max_bytes: int) -> bytearray:
+    """
+    Читает загруженный файл кусками с жестким лимитом размера.
+    Слишком большой файл отклоняется (413), не дочитываясь до конца.
+    """
+    if file.size is not None and file.size > max_bytes:
+        raise HTTPException(status_code=413, detail="File is too large")
+
+    content = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        content += chunk
+        if len(content) > max_bytes:
+            raise HTTPException(status_code=413, detail="File is too large")
+    return content
+
+class UploadSizeLimit:
+    """
+    ASGI-middleware: ограничивает тело запросов к маршрутам загрузки (path_prefix).
+
+    Запрос с Content-Length больше лимита отклоняется сразу, до чтения тела.
+    Без Content-Length (chunked) байты считаются по мере чтения, и 413
+    отдается, как только лимит превышен: multipart-парсер Starlette не
+    успевает сохранить остаток во временный файл. read_upload ограничивает
+    уже только копию файла в памяти.
+    """
+
+    def __init__(self, app, max_bytes: int, path_prefix: str):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.path_prefix = path_prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.path_prefix):
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = JSONResponse(status_code=413, content={"detail": "File is too large"})
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # HTTPException из чтения тела FastAPI отдает как есть (413), а не как 400
+                    raise HTTPException(status_code=413, detail="File is too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+def process_image(content: bytes) -> tuple[bytes, dict]:
+    """
+    Выполняется в пуле воркеров: декодирование, ресайз, кодирование в JPEG.
+    Возвращает (JPEG-байты, длительность каждого этапа в секундах).
+    """
+    t0 = time.perf_counter()
+    image = Image.open(io.BytesIO(content))
+    if image.format == "JPEG":
+        # JPEG умеет декодироваться сразу в масштабе 1/2, 1/4 или 1/8:
+        # берем самый мелкий, который почти не меньше целевого размера.
+        # Фото 12 Мп так распаковывается в ~0.75 Мп вместо полного размера.
+        scale = min(MAX_SIZE[0] / image.width, MAX_SIZE[1] / image.height)
+        if scale < 1:
+            image.draft("RGB", (int(image.width * scale * DRAFT_TOLERANCE), int(image.height * scale * DRAFT_TOLERANCE)))
+    image.load()
+
+    # Конвертируем в RGB (если был PNG с прозрачностью, иначе упадет)
+    if image.mode in ("RGBA", "P"):
+        image = image.convert("RGB")
+    t1 = time.perf_counter()
+
+    # Ресайз (если больше 1024px по широкой стороне).
+    # reducing_gap: сначала быстрое целочисленное уменьшение, потом LANCZOS
+    image.thumbnail(MAX_SIZE, Image.Resampling.LANCZOS, reducing_gap=3.0)
+    t2 = time.perf_counter()
+
+    # Кодируем с качеством 70% (визуально не видно, вес падает в 5-10 раз)
+    output = io.BytesIO()
+    image.save(output, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    t3 = time.perf_counter()
+
+    return output.getvalue(), {"decode": t1 - t0, "resize": t2 - t1, "encode": t3 - t2}
+
+def write_file(path: str, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+
+@dataclass
+class UploadedImage:
+    """
+    Обработанная картинка из чата: JPEG-байты уходят прямо в запрос к ИИ,
+    а запись на диск идет параллельно в фоне.
+    """
+    path: str
+    data: bytes
+    persist_task: asyncio.Task
+
+    async def wait_saved(self) -> str | None:
+        """Дожидается записи на диск. Возвращает путь или None, если записать не удалось."""
+        try:
+            await self.persist_task
+            return self.path
+        except Exception as e:
+            print(f"Image save error ({self.path}): {e}")
+            return None
+
+class ImageStats:
+    """Накопительные тайминги обработки картинок (для подбора размера пула)."""
+
+    def __init__(self):
+        self.count = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.total = {stage: 0.0 for stage in (*STAGES, "queue")}
+        self.max = {stage: 0.0 for stage in (*STAGES, "queue")}
+
+    def record(self, timings: dict):
+        self.count += 1
+        for stage, value in timings.items():
+            self.total[stage] += value
+            self.max[stage] = max(self.max[stage], value)
+
+    def snapshot(self) -> dict:
+        """Средние и максимальные тайминги по этапам, в миллисекундах."""
+        return {
+            "count": self.count,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "stages": [
+                {
+                    "name": stage,
+                    "avg_ms": round(self.total[stage] / self.count * 1000, 1) if self.count else 0.0,
+                    "max_ms": round(self.max[stage] * 1000, 1),
+                }
+                for stage in (*STAGES, "queue")
+            ],
+        }
+
+class ImageProcessor:
+    """
+    Обработка загруженных картинок в отдельном пуле (потоков или процессов),
+    чтобы Pillow не блокировал event loop.
+
+    Одновременно принимается не больше workers + queue_depth картинок:
+    остальные сразу получают 503, а не копятся в памяти.
+    """
+
+    def __init__(self, workers: int, queue_depth: int, timeout: float, kind: str = "thread"):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self.kind = kind
+        self.stats = ImageStats()
+        self._executor = None
+        self._in_flight = 0
+
+    def start(self):
+        if self._executor is None:
+            executor_cls = ProcessPoolExecutor if self.kind == "process" else ThreadPoolExecutor
+            self._executor = executor_cls(max_workers=self.workers)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def _release(self, _future=None):
+        self._in_flight -= 1
+
+    async def process(self, content: bytes | bytearray) -> tuple[bytes, dict]:
+        if self._in_flight >= self.workers + self.queue_depth:
+            self.stats.rejected += 1
+            raise HTTPException(status_code=503, detail="Image processing is busy, try again later")
+
+        self.start()
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        self._in_flight += 1
+        future = loop.run_in_executor(self._executor, process_image, content)
+        # Слот освобождается, когда задача реально закончилась (даже после таймаута),
+        # иначе при зависаниях пул переполнится незаметно для счетчика
+        future.add_done_callback(self._release)
+
+        try:
+            data, timings = await asyncio.wait_for(asyncio.shield(future), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self.stats.timeouts += 1
+            raise HTTPException(status_code=504, detail="Image processing timed out")
+        except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError) as e:
+            self.stats.errors += 1
+            # Текст исключения PIL содержит repr внутренних объектов — в ответ не отдаем
+            print(f"Invalid image: {e}")
+            raise HTTPException(status_code=400, detail="Invalid image")
+
+        # Все, что не ушло на этапы обработки, — ожидание свободного воркера
+        timings["queue"] = max(0.0, time.perf_counter() - started - sum(timings.values()))
+        self.stats.record(timings)
+        return data, timings
+
+    async def ingest(self, file: UploadFile, upload_dir: str) -> UploadedImage:
+        """
+        Полный прием картинки из чата: чтение с лимитом, обработка в пуле,
+        фоновая запись на диск (всегда в JPG — экономит место).
+        """
+        content = await read_upload(file, settings.MAX_UPLOAD_BYTES)
+        data, _ = await self.process(content)
+
+        os.makedirs(upload_dir, exist_ok=True)
+        path = f"{upload_dir}/{uuid.uuid4()}.jpg"
+        persist_task = asyncio.create_task(asyncio.to_thread(write_file, path, data))
+        return UploadedImage(path=path, data=data, persist_task=persist_task)
+
+image_processor = ImageProcessor(
+    workers=settings.IMAGE_POOL_WORKERS,
+    queue_depth=settings.IMAGE_QUEUE_DEPTH,
+    timeout=settings.IMAGE_TIMEOUT,
+    kind=settings.IMAGE_POOL_KIND,
+)
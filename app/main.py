@@ -1,39 +1,94 @@
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Depends, Request, HTTPException, Form, UploadFile, File, BackgroundTasks
-from fastapi.responses import FileResponse, RedirectResponse
+from fastapi.responses import FileResponse, RedirectResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 from sqladmin import Admin, ModelView, BaseView, expose
 from sqladmin.authentication import AuthenticationBackend
 from starlette.middleware.sessions import SessionMiddleware
 from sqlalchemy.future import select
+from sqlalchemy import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.config import settings
-from app.database import engine, Base, get_db, AsyncSessionLocal
-from app.models import User, Assistant, Message, Product, UserClick
+from app.database import engine, get_read_db, AsyncSessionLocal, ReadSessionLocal, dialect_insert, dispose_engines
+from app.models import User, Assistant, Message, Product, UserClick, get_current_time
 from app.security import validate_telegram_data
-from app.services import get_ai_response, fetch_salebot_id, move_client_to_block
-from app.metrics import DashboardMetrics
+from app.services import get_ai_response, build_ai_request, stream_ai_response
+from app.salebot import move_client_to_block, salebot_linker, get_http_client, close_http_client
+from app.metrics import dashboard_engine
+from app.rollups import rollup_job
+from app.catalog import product_catalog
+from app.registry import assistant_registry, etag_matches
+from app.counters import product_counters, increment_user_messages, refresh_user_activity
+from app.clicks import click_queue, impression_queue
+from app.images import image_processor, UploadedImage, UploadSizeLimit
+from app.history import conversation_cache, HistoryEntry
+from app.writes import write_coordinator
+from app.sqlstats import sql_stats
 from pydantic import BaseModel
 from markupsafe import Markup
-from PIL import Image
-import io
+import json
 import gspread 
-import os
-import uuid
 from oauth2client.service_account import ServiceAccountCredentials 
 from starlette.responses import RedirectResponse 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Таблицы теперь создаются через Alembic
+    # Прогреваем кэш каталога, чтобы первый чат не платил за загрузку
+    try:
+        await product_catalog.ensure_loaded()
+    except Exception as e:
+        print(f"Catalog warm-up error: {e}")
+    try:
+        await assistant_registry.ensure_loaded()
+    except Exception as e:
+        print(f"Assistant registry warm-up error: {e}")
+    write_coordinator.start()
+    product_counters.start()
+    rollup_job.start()
+    click_queue.start()
+    impression_queue.start()
+    image_processor.start()
+    get_http_client()
     yield
-    # Shutdown: Close engine connections
-    await engine.dispose()
+    # Shutdown: дописываем накопленные показы/клики, затем закрываем соединения
+    await rollup_job.stop()
+    await click_queue.stop()
+    await impression_queue.stop()
+    await product_counters.stop()
+    await salebot_linker.stop()
+    # Писатель — последним: очереди выше сдают ему свои последние пачки
+    await write_coordinator.stop()
+    image_processor.shutdown()
+    await close_http_client()
+    await dispose_engines()
 
 # 1. Создаем приложение
 app = FastAPI(lifespan=lifespan)
 app.add_middleware(SessionMiddleware, secret_key=settings.SECRET_KEY)
 
+# Тело запросов чата ограничиваем до разбора формы: по заголовку Content-Length
+# или подсчетом байт при чтении (chunked). Запас на остальные поля формы и multipart-обвязку.
+app.add_middleware(UploadSizeLimit, max_bytes=settings.MAX_UPLOAD_BYTES + 64 * 1024, path_prefix="/api/chat")
+
+@app.middleware("http")
+async def sql_accounting(request: Request, call_next):
+    # Считаем SQL запроса (app/sqlstats.py). У потоковых ответов запросы после отдачи
+    # заголовков (конец /api/chat/stream) не попадают ни в заголовки, ни в сводку эндпоинта
+    current = sql_stats.begin()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    # Шаблон пути, а не сам путь: /admin/{identity}/details/{pk} — одна строка сводки.
+    # Без шаблона (статика, 404) — одна общая строка: иначе каждый путь файла или скана
+    # заводил бы свою запись в сводке навсегда
+    path = request.scope.get("root_path", "") + route.path if route is not None else "<unmatched>"
+    label = f"{request.method} {path}"
+    if settings.SQL_DEBUG_HEADERS:
+        response.headers["X-SQL-Count"] = str(current.count)
+        response.headers["X-SQL-Time-Ms"] = f"{current.seconds * 1000:.1f}"
+    sql_stats.finish(label, current)
+    return response
+
 # --- ADMIN PANEL AUTH ---
 class AdminAuth(AuthenticationBackend):
     async def login(self, request: Request) -> bool:
@@ -66,20 +121,17 @@ class DashboardAdmin(BaseView):
 
     @expose("/dashboard", methods=["GET"])
     async def report_page(self, request: Request):
-        async with AsyncSessionLocal() as session:
-            metrics_service = DashboardMetrics(session)
-            
-            metrics = {
-                "dau": await metrics_service.get_dau(),
-                "mau": await metrics_service.get_mau(),
-                "retention": await metrics_service.get_retention(),
-                "assistant_popularity": await metrics_service.get_assistant_popularity(),
-                "message_volume": await metrics_service.get_message_volume(),
-                "conversion_rate": await metrics_service.get_conversion_rate(),
-                "ctr_stats": await metrics_service.get_ctr_stats()
-            }
-
-        return await self.templates.TemplateResponse(request, "dashboard.html", context={"metrics": metrics})
+        # Запросы метрик идут параллельно и кэшируются (см. DashboardEngine в app/metrics.py)
+        dashboard = await dashboard_engine.get()
+        metrics = {
+            **dashboard["metrics"],
+            "images": image_processor.stats.snapshot(),
+            "history_cache": conversation_cache.snapshot(),
+            "writes": write_coordinator.snapshot(),
+            "sql": sql_stats.snapshot(),
+        }
+
+        return await self.templates.TemplateResponse(request, "dashboard.html", context={"metrics": metrics, "dashboard": dashboard})
 
 # Инициализируем админку сразу после создания app
 # index_view не поддерживается в конструкторе этой версии sqladmin, используем add_view
@@ -97,16 +149,17 @@ class UserAdmin(ModelView, model=User):
         User.tg_id, 
         User.username, 
         User.created_at, 
-        "msg_count",   # Виртуальная колонка (счетчик) 
-        "clicks_count" # Виртуальная колонка (счетчик) 
+        User.total_messages, 
+        User.clicks_count 
     ] 
     
     column_labels = { 
         User.tg_id: "ID", 
         User.username: "Юзернейм", 
         User.created_at: "Регистрация", 
-        "msg_count": "Сообщений", 
-        "clicks_count": "Кликов", 
+        User.total_messages: "Сообщений", 
+        User.clicks_count: "Кликов", 
+        User.last_message_at: "Последняя активность", 
         "history_link": "Переписка",   # Лейбл для ссылки 
         "clicks_link": "Клики"         # Лейбл для ссылки 
     } 
@@ -118,71 +171,61 @@ class UserAdmin(ModelView, model=User):
         User.tg_id, 
         User.username, 
         User.created_at, 
-        "msg_count", 
-        "clicks_count", 
-        "last_active", 
+        User.total_messages, 
+        User.clicks_count, 
+        User.last_message_at, 
         # --- ВМЕСТО СПИСКОВ ВСТАВЛЯЕМ НАШИ ВИРТУАЛЬНЫЕ ССЫЛКИ --- 
         "history_link", 
         "clicks_link" 
     ] 
  
     # --- ФОРМАТТЕРЫ (Логика отображения) --- 
+    # Счетчики — обычные колонки users (ведутся при записи сообщений и кликов),
+    # сами сообщения и клики в список и карточку не загружаются
     
-    # Для счетчиков 
-    def _format_msg_count(model, context): 
-        # Фильтруем сообщения по роли 'user' для консистентности
-        return len([m for m in model.messages if m.role == 'user']) 
-         
-    def _format_clicks_count(model, context): 
-        # Проверка на случай, если clicks еще нет в модели 
-        return len(model.clicks) if hasattr(model, 'clicks') else 0 
- 
     def _format_last_active(model, context): 
-        # Фильтруем по 'user' роли
-        user_messages = [m for m in model.messages if m.role == 'user']
-        if not user_messages: 
+        if not model.last_message_at: 
             return "-" 
-        last_msg = max(user_messages, key=lambda m: m.id) 
-        return last_msg.created_at.strftime("%Y-%m-%d %H:%M") 
+        return model.last_message_at.strftime("%Y-%m-%d %H:%M") 
  
     # Для ССЫЛОК (Самое важное) 
     def _format_history_link(model, context): 
-        count = len([m for m in model.messages if m.role == 'user']) 
         # Формируем HTML ссылку. Класс btn делает её похожей на кнопку. 
         # Ссылка ведет на /admin/message/list и ставит фильтр ?search=ID 
         return Markup( 
             f'<a href="/admin/message/list?search={model.tg_id}" ' 
             f'class="btn btn-primary btn-sm">' 
-            f'📂 Открыть переписку ({count})</a>' 
+            f'📂 Открыть переписку ({model.total_messages})</a>' 
         ) 
  
     def _format_clicks_link(model, context): 
-        count = len(model.clicks) if hasattr(model, 'clicks') else 0 
         return Markup( 
             f'<a href="/admin/user-click/list?search={model.tg_id}" ' 
             f'class="btn btn-secondary btn-sm">' 
-            f'🖱️ Открыть клики ({count})</a>' 
+            f'🖱️ Открыть клики ({model.clicks_count})</a>' 
         ) 
  
     # Подключаем форматтеры 
     column_formatters = { 
-        "msg_count": _format_msg_count, 
-        "clicks_count": _format_clicks_count, 
-        "last_active": _format_last_active,
         User.created_at: lambda m, a: m.created_at.strftime("%Y-%m-%d %H:%M") if m.created_at else ""
     } 
     
     # Для детального просмотра нужны те же форматтеры + ссылки 
     column_formatters_detail = { 
-        "msg_count": _format_msg_count, 
-        "clicks_count": _format_clicks_count, 
-        "last_active": _format_last_active, 
+        User.last_message_at: _format_last_active, 
         "history_link": _format_history_link, # Подключаем ссылку 1 
         "clicks_link": _format_clicks_link,    # Подключаем ссылку 2 
         User.created_at: lambda m, a: m.created_at.strftime("%Y-%m-%d %H:%M") if m.created_at else ""
     } 
+
+    # В форме редактирования не нужны списки всех сообщений и кликов,
+    # а счетчики ведет приложение
+    form_excluded_columns = [User.messages, User.clicks, User.total_messages, User.last_message_at, User.clicks_count]
+
+    async def after_model_delete(self, model, request):
+        conversation_cache.invalidate_user(model.tg_id)
     
-    column_sortable_list = ["tg_id", "username", "created_at"]
+    column_sortable_list = ["tg_id", "username", "created_at", "total_messages", "clicks_count", "last_message_at"]
 
 # Общий раздел "История переписки"
 class MessageAdmin(ModelView, model=Message):
@@ -237,6 +280,11 @@ class MessageAdmin(ModelView, model=Message):
     can_create = False
     can_edit = False
     can_delete = True
+
+    # Удаленное сообщение не должно остаться в кэше истории чата и в счетчиках
+    async def after_model_delete(self, model, request):
+        conversation_cache.invalidate(model.user_id, model.assistant_slug)
+        await refresh_user_activity(model.user_id)
     
 class UserClickAdmin(ModelView, model=UserClick): 
     identity = "user-click"
@@ -244,7 +292,7 @@ class UserClickAdmin(ModelView, model=UserClick):
     name_plural = "История кликов" 
     icon = "fa-solid fa-hand-pointer" # Иконка пальца 
     
-    column_list = [UserClick.id, UserClick.user_id, UserClick.product_id, UserClick.created_at] 
+    column_list = [UserClick.id, UserClick.user_id, UserClick.product_id, UserClick.assistant_slug, UserClick.created_at] 
     
     # ВАЖНО: Добавляем user_id в поиск, чтобы фильтр ?search=123 работал 
     column_searchable_list = [UserClick.user_id] 
@@ -254,6 +302,9 @@ class UserClickAdmin(ModelView, model=UserClick):
     can_create = False 
     can_edit = False 
     can_delete = True 
+
+    async def after_model_delete(self, model, request):
+        await refresh_user_activity(model.user_id)
     
 class AssistantAdmin(ModelView, model=Assistant):
     identity = "assistant"
@@ -269,6 +320,13 @@ class AssistantAdmin(ModelView, model=Assistant):
     
     form_columns = [Assistant.slug, Assistant.name, Assistant.description, Assistant.icon_emoji, Assistant.welcome_message, Assistant.openrouter_preset, Assistant.is_active]
     
+    # Любая правка ассистента сбрасывает реестр (пресеты чата и /api/assistants)
+    async def after_model_change(self, data, model, is_created, request):
+        assistant_registry.invalidate()
+
+    async def after_model_delete(self, model, request):
+        assistant_registry.invalidate()
+
     # --- ЛОГИКА СИНХРОНИЗАЦИИ --- 
     @expose("/sync_google", methods=["POST"]) 
     async def sync_google(self, request: Request): 
@@ -322,6 +380,7 @@ class AssistantAdmin(ModelView, model=Assistant):
                          count_added += 1 
                  
                 await session.commit() 
+            assistant_registry.invalidate()
              
             print(f"Assistant Sync complete: {count_added} added, {count_updated} updated.") 
  
@@ -359,6 +418,13 @@ class ProductAdmin(ModelView, model=Product):
     column_formatters = { 
         "ctr": lambda m, a: f"{round((m.clicks / m.impressions * 100), 2) if m.impressions > 0 else 0}%" 
     } 
+
+    # Любая правка товара сбрасывает кэш каталога
+    async def after_model_change(self, data, model, is_created, request):
+        product_catalog.invalidate()
+
+    async def after_model_delete(self, model, request):
+        product_catalog.invalidate()
  
     # --- 2. ЛОГИКА СИНХРОНИЗАЦИИ --- 
     @expose("/sync_google", methods=["POST"]) 
@@ -414,6 +480,8 @@ class ProductAdmin(ModelView, model=Product):
                          count_added += 1 
                  
                 await session.commit() 
+ 
+            product_catalog.invalidate()
              
             # Сообщение об успехе (можно вывести в лог или через flash-message, если настроено) 
             print(f"Sync complete: {count_added} added, {count_updated} updated.") 
@@ -438,9 +506,13 @@ class ChatRequest(BaseModel):
     text: str
 
 @app.get("/api/assistants")
-async def get_assistants(db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(Assistant).where(Assistant.is_active == True))
-    return result.scalars().all()
+async def get_assistants(request: Request):
+    # Готовый JSON из реестра; если у клиента та же версия — 304 без тела
+    body, etag = await assistant_registry.get_active_payload()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @app.get("/api/is_admin")
 async def is_admin(user_id: int):
@@ -452,8 +524,9 @@ async def get_history(
     assistant_slug: str,
     limit: int = 20,
     offset: int = 0,
+    before_id: int | None = None,
     request: Request = None,
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     # 1. Валидация (Mock)
     # init_data = request.headers.get("X-Telegram-Init-Data")
@@ -461,15 +534,22 @@ async def get_history(
     user_data = {"id": 12346, "username": "test_user2"}
     user_id = user_data["id"]
 
-    # 2. Загрузка истории
-    history_q = await db.execute(
-        select(Message)
+    # 2. Загрузка истории (новые -> старые) по индексу (user_id, assistant_slug, id).
+    # before_id — курсор для подгрузки: id самого старого уже показанного сообщения.
+    # В отличие от offset, не замедляется при прокрутке вглубь и не дает дублей,
+    # если за это время в диалог добавились новые сообщения.
+    query = (
+        select(Message.id, Message.role, Message.content, Message.image_path)
         .where(Message.user_id == user_id, Message.assistant_slug == assistant_slug)
         .order_by(Message.id.desc())
-        .offset(offset)
         .limit(limit)
     )
-    history = history_q.scalars().all()
+    if before_id is not None:
+        query = query.where(Message.id < before_id)
+    elif offset:
+        query = query.offset(offset)
+    history_q = await db.execute(query)
+    history = history_q.all()
     
     return [
         {"role": msg.role, "content": msg.content, "id": msg.id, "image_path": msg.image_path}
@@ -477,29 +557,107 @@ async def get_history(
     ]
 
 @app.get("/api/click")
-async def track_click(product_id: int, user_id: int = None, db: AsyncSession = Depends(get_db)):
+async def track_click(product_id: int, user_id: int = None, assistant: str = None, db: AsyncSession = Depends(get_read_db)):
     """
     Эндпоинт для трекинга кликов.
-    1. Ищет товар по ID.
-    2. Увеличивает счетчик кликов.
-    3. Если передан user_id, сохраняет клик пользователя.
-    4. Редиректит пользователя на целевую ссылку.
+    1. Берет ссылку товара из кэша каталога (без запроса в БД).
+    2. Увеличивает счетчик кликов (буфер, пишется в БД пачкой).
+    3. Если передан user_id, ставит клик пользователя в очередь на запись
+       (вместе с ассистентом, в ответе которого была ссылка).
+    4. Сразу редиректит пользователя на целевую ссылку.
     """
-    product = await db.get(Product, product_id)
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
+    link = await product_catalog.get_link(product_id)
+    if link is None:
+        # Товара нет в кэше (например, снят с показа) — медленный путь через БД
+        product = await db.get(Product, product_id)
+        if not product:
+            raise HTTPException(status_code=404, detail="Product not found")
+        link = product.link
     
     # Общий счетчик
-    product.clicks += 1
+    product_counters.add_click(product_id)
     
     # Персональный клик
     if user_id:
-        click = UserClick(user_id=user_id, product_id=product_id)
-        db.add(click)
-        
-    await db.commit()
+        click_queue.put(user_id=user_id, product_id=product_id, assistant_slug=assistant)
     
-    return RedirectResponse(url=product.link)
+    return RedirectResponse(url=link, status_code=302)
+
+async def prepare_chat(background_tasks: BackgroundTasks, user_data: dict, assistant_slug: str, file: UploadFile | None):
+    """
+    Общая часть /api/chat и /api/chat/stream до запроса к ИИ.
+    Возвращает (user_id, картинка_или_None, история).
+
+    Соединение с БД (из пула только для чтения) берется на короткое чтение пользователя и истории
+    и возвращается в пул до запроса к ИИ, который может идти десятки секунд.
+    """
+    user_id = user_data["id"]
+
+    # 1. Обработка файла: читаем с лимитом размера и ужимаем в пуле воркеров
+    # (app/images.py), чтобы декодирование фотографии не блокировало event loop.
+    # На диск картинка пишется в фоне, пока идет запрос к ИИ.
+    # Делается до обращения к БД, чтобы не держать соединение на время обработки.
+    image = None
+    if file:
+        image = await image_processor.ingest(file, settings.UPLOAD_DIR)
+
+    async with ReadSessionLocal() as db:
+        # 2. Пользователь и история: окно диалога из кэша в памяти, из БД — только при промахе
+        user = await db.get(User, user_id)
+        history = await conversation_cache.get(db, user_id, assistant_slug)
+    # Здесь транзакция закрыта и соединение уже в пуле
+    salebot_id = user.salebot_id if user else None
+
+    if not user:
+        # Новый пользователь создается через общего писателя (app/writes.py);
+        # ON CONFLICT — на случай, если параллельный запрос успел его создать
+        username = user_data.get("username", "Anon")
+        await write_coordinator.submit(lambda conn: conn.execute(
+            dialect_insert(conn, User.__table__)
+            .values(tg_id=user_id, username=username)
+            .on_conflict_do_nothing(index_elements=["tg_id"])
+        ))
+
+    # ================= ЛОГИКА SALEBOT ================= 
+    # А. Если ID клиента уже знаем — ставим задачу в очередь (выполнится после ответа пользователю) 
+    if salebot_id: 
+        background_tasks.add_task(move_client_to_block, salebot_id, settings.SALEBOT_TARGET_BLOCK_ID) 
+    # Б. Если не знаем — ищем в фоне, не задерживая ответ. Найденный ID сохранится
+    # в БД, и клиент сразу уйдет в блок; неизвестных Salebot'у не переспрашиваем до TTL
+    else: 
+        salebot_linker.link_in_background(user_id) 
+    # ================================================== 
+
+    return user_id, image, history
+
+async def save_messages(user_id: int, assistant_slug: str, text: str, image: UploadedImage | None, ai_answer: str):
+    """
+    Сохраняет пару сообщений через общего писателя (app/writes.py):
+    они коммитятся в одной пачке с записями других запросов, а функция
+    возвращается, когда коммит уже сделан.
+    """
+    # Сообщение ссылается на файл, поэтому дожидаемся фоновой записи картинки
+    image_path = await image.wait_saved() if image else None
+    sent_at = get_current_time()
+    rows = [
+        {"user_id": user_id, "assistant_slug": assistant_slug, "role": "user", "content": text, "image_path": image_path, "created_at": sent_at},
+        {"user_id": user_id, "assistant_slug": assistant_slug, "role": "assistant", "content": ai_answer, "image_path": None, "created_at": sent_at},
+    ]
+
+    async def write(conn):
+        result = await conn.execute(
+            insert(Message.__table__).returning(Message.__table__.c.id, sort_by_parameter_order=True), rows
+        )
+        # Счетчики пользователя — в той же транзакции, что и сами сообщения
+        await conn.execute(increment_user_messages(user_id, sent_at))
+        return result.scalars().all()
+
+    ids = await write_coordinator.submit(write)
+    # В кэш — только после коммита, чтобы окно не опережало БД
+    conversation_cache.append(user_id, assistant_slug, ids, [
+        HistoryEntry(role="user", content=text or ""),
+        HistoryEntry(role="assistant", content=ai_answer or ""),
+    ])
 
 @app.post("/api/chat")
 async def chat(
@@ -507,9 +665,10 @@ async def chat(
     background_tasks: BackgroundTasks,
     assistant_slug: str = Form(...),
     text: str = Form(...),
-    file: UploadFile = File(None),
-    db: AsyncSession = Depends(get_db)
+    file: UploadFile = File(None)
 ):
+    # Сессия БД не берется на весь запрос: чтение контекста, ответ ИИ (без соединения)
+    # и сохранение — отдельные короткие фазы
     # Мут валидации для тестов
     # 1. Валидация
     # init_data = request.headers.get("X-Telegram-Init-Data")
@@ -517,80 +676,71 @@ async def chat(
     # user_data = validate_telegram_data(init_data) 
     user_data = {"id": 12346, "username": "test_user2"} # Раскомментируйте для теста в браузере
     
-    user_id = user_data["id"]
+    user_id, image, history = await prepare_chat(background_tasks, user_data, assistant_slug, file)
 
-    # 2. Создаем/обновляем юзера
-    user = await db.get(User, user_id)
-    if not user:
-        user = User(tg_id=user_id, username=user_data.get("username", "Anon"))
-        db.add(user)
-        await db.commit()
+    # 4. Ответ ИИ
+    ai_answer = await get_ai_response(text, assistant_slug, history, user_id=user_id, image_data=image.data if image else None)
 
-    # ================= ЛОГИКА SALEBOT ================= 
-    # А. Проверяем, знаем ли мы уже ID клиента? 
-    current_salebot_id = user.salebot_id 
-    
-    # Б. Если не знаем — спрашиваем у Salebot и сохраняем 
-    if not current_salebot_id: 
-        found_id = await fetch_salebot_id(user_id) # user_id это tg_id 
-        if found_id: 
-            user.salebot_id = found_id 
-            current_salebot_id = found_id 
-            await db.commit() # Сохраняем в БД навсегда 
- 
-    # В. Если ID есть — ставим задачу в очередь (выполнится после ответа пользователю) 
-    if current_salebot_id: 
-        background_tasks.add_task(move_client_to_block, current_salebot_id, settings.SALEBOT_TARGET_BLOCK_ID) 
-    # ================================================== 
+    # 5. Сохранение (групповой коммит, ждем его завершения)
+    await save_messages(user_id, assistant_slug, text, image, ai_answer)
 
-    # 2.1 Обработка файла
-    saved_image_path = None
-    if file:
-        os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
-        filename = f"{uuid.uuid4()}.jpg" # Всегда сохраняем в JPG (экономит место)
-        saved_image_path = f"{settings.UPLOAD_DIR}/{filename}"
-        
-        # --- ОПТИМИЗАЦИЯ ---
-        # 1. Читаем файл в память
-        content = await file.read()
-        image = Image.open(io.BytesIO(content))
-        
-        # 2. Конвертируем в RGB (если был PNG с прозрачностью, иначе упадет)
-        if image.mode in ("RGBA", "P"):
-            image = image.convert("RGB")
-            
-        # 3. Ресайз (если больше 1024px по широкой стороне)
-        max_size = (1024, 1024)
-        image.thumbnail(max_size, Image.Resampling.LANCZOS)
-        
-        # 4. Сохраняем с качеством 70% (визуально не видно, вес падает в 5-10 раз)
-        image.save(saved_image_path, "JPEG", quality=70, optimize=True)
-
-    # 3. Загрузка истории
-    history_result = await db.execute(
-        select(Message)
-        .where(Message.user_id == user_id, Message.assistant_slug == assistant_slug)
-        .order_by(Message.id.desc())
-        .limit(settings.CHAT_HISTORY_LIMIT)
-    )
-    history = history_result.scalars().all()[::-1]
+    return {"response": ai_answer}
 
-    # 4. Ответ ИИ
-    ai_answer = await get_ai_response(text, assistant_slug, history, db, user_id=user_id, image_path=saved_image_path)
-
-    # 5. Сохранение
-    msg_user = Message(
-        user_id=user_id, 
-        assistant_slug=assistant_slug, 
-        role="user", 
-        content=text,
-        image_path=saved_image_path
-    )
-    msg_ai = Message(user_id=user_id, assistant_slug=assistant_slug, role="assistant", content=ai_answer)
-    db.add_all([msg_user, msg_ai])
-    await db.commit()
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-    return {"response": ai_answer}
+@app.post("/api/chat/stream")
+async def chat_stream(
+    request: Request, 
+    background_tasks: BackgroundTasks,
+    assistant_slug: str = Form(...),
+    text: str = Form(...),
+    file: UploadFile = File(None)
+):
+    """
+    То же, что /api/chat, но ответ ИИ приходит потоком (Server-Sent Events):
+    - event: delta  data: {"text": "..."}     — очередной кусок ответа
+    - event: done   data: {"response": "..."} — полный ответ, сообщения сохранены
+    - event: error  data: {"detail": "..."}   — ошибка ИИ или сохранения; поток на этом заканчивается
+    """
+    # 1. Валидация (Mock, как в /api/chat)
+    # init_data = request.headers.get("X-Telegram-Init-Data")
+    # user_data = validate_telegram_data(init_data) 
+    user_data = {"id": 12346, "username": "test_user2"}
+
+    user_id, image, history = await prepare_chat(background_tasks, user_data, assistant_slug, file)
+
+    ai_request, ad_product_ids = await build_ai_request(text, assistant_slug, history, user_id=user_id, image_data=image.data if image else None)
+
+    async def event_stream():
+        parts = []
+        try:
+            async for delta in stream_ai_response(ai_request, ad_product_ids, user_id, assistant_slug):
+                parts.append(delta)
+                yield sse_event("delta", {"text": delta})
+        except Exception as e:
+            print(f"AI stream error: {e}")
+            yield sse_event("error", {"detail": "AI request failed"})
+            return
+
+        ai_answer = "".join(parts)
+
+        # Сохраняем через общего писателя, соединение на время потока не держим.
+        # Заголовки и ответ уже отправлены: ошибку сохранения отдаем событием, а не 500
+        try:
+            await save_messages(user_id, assistant_slug, text, image, ai_answer)
+        except Exception as e:
+            print(f"Save messages error: {e}")
+            yield sse_event("error", {"detail": "Failed to save messages"})
+            return
+
+        yield sse_event("done", {"response": ai_answer})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 # --- ФРОНТЕНД ---
 # Важно: Сначала монтируем статику по пути /static
@@ -1,10 +1,12 @@
 from datetime import datetime, timezone, timedelta
-from sqlalchemy import Column, Integer, String, Text, Boolean, BigInteger, ForeignKey, DateTime, select, func
-from sqlalchemy.orm import relationship, column_property
+from sqlalchemy import Column, Integer, String, Text, Boolean, BigInteger, ForeignKey, DateTime, Date, Float, LargeBinary, Index
+from sqlalchemy.orm import relationship
 from app.database import Base
 
 def get_current_time():
-    return datetime.now(timezone(timedelta(hours=3))).replace(microsecond=0)
+    # Время по Москве без tzinfo: колонки DateTime без часового пояса, и asyncpg
+    # (PostgreSQL) не принимает для них datetime с tzinfo; SQLite хранил то же значение
+    return datetime.now(timezone(timedelta(hours=3))).replace(microsecond=0, tzinfo=None)
 
 class UserClick(Base):
     """
@@ -15,6 +17,7 @@ class UserClick(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(BigInteger, ForeignKey("users.tg_id"))
     product_id = Column(Integer, ForeignKey("products.id"))
+    assistant_slug = Column(String, nullable=True)  # Ассистент, в ответе которого была ссылка
     created_at = Column(DateTime, default=get_current_time)
     
     user = relationship("User", back_populates="clicks")
@@ -26,8 +29,16 @@ class User(Base):
     username = Column(String, nullable=True)
     salebot_id = Column(String, nullable=True)
     created_at = Column(DateTime, default=get_current_time)  
-    messages = relationship("Message", back_populates="user", lazy="selectin")
-    clicks = relationship("UserClick", back_populates="user", lazy="selectin")
+    # Счетчики активности: ведутся вместе с записью сообщений и кликов
+    # (см. app/counters.py), чтобы админка не считала их по таблицам событий
+    total_messages = Column(Integer, nullable=False, default=0, server_default="0")  # только role="user"
+    last_message_at = Column(DateTime, nullable=True)
+    clicks_count = Column(Integer, nullable=False, default=0, server_default="0")
+    # Переписка и клики у активных пользователей исчисляются тысячами строк,
+    # поэтому с пользователем они не грузятся: кому нужны — загружает явно
+    # (selectinload) или читает постранично через Message/UserClick.
+    messages = relationship("Message", back_populates="user", lazy="select")
+    clicks = relationship("UserClick", back_populates="user", lazy="select")
 
 class Assistant(Base):
     __tablename__ = "assistants"
@@ -67,26 +78,104 @@ class Message(Base):
 
     user = relationship("User", back_populates="messages")
 
-# Calculated properties for User
-User.total_messages = column_property(
-    select(func.count(Message.id))
-    .where(Message.user_id == User.tg_id)
-    .where(Message.role == "user")
-    .correlate_except(Message)
-    .scalar_subquery()
-)
-
-User.last_message_at = column_property(
-    select(func.max(Message.created_at))
-    .where(Message.user_id == User.tg_id)
-    .where(Message.role == "user")
-    .correlate_except(Message)
-    .scalar_subquery()
-)
-
-User.clicks_count = column_property(
-    select(func.count(UserClick.id))
-    .where(UserClick.user_id == User.tg_id)
-    .correlate_except(UserClick)
-    .scalar_subquery()
-)
\ No newline at end of file
+    __table_args__ = (
+        # История диалога (чат и /api/history) читается по этому индексу без сортировки
+        Index("ix_messages_user_assistant_id", "user_id", "assistant_slug", "id"),
+    )
+
+class AdImpression(Base):
+    """
+    Журнал показов рекламы (только вставка, пишется пачками из app/clicks.py):
+    ссылка на товар попала в ответ ассистента пользователю.
+    """
+    __tablename__ = "ad_impressions"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger, ForeignKey("users.tg_id"), nullable=True)
+    product_id = Column(Integer, ForeignKey("products.id"))
+    assistant_slug = Column(String, nullable=True)
+    created_at = Column(DateTime, default=get_current_time)
+
+    # Поиск последнего показа перед кликом (задержка показ -> клик)
+    __table_args__ = (Index("ix_ad_impressions_user_product_time", "user_id", "product_id", "created_at"),)
+
+# --- Агрегаты для дашборда (заполняет app/rollups.py) ---
+
+class DailyUserActivity(Base):
+    """Сколько сообщений пользователь отправил за день (для DAU/MAU)."""
+    __tablename__ = "daily_user_activity"
+    day = Column(Date, primary_key=True)
+    user_id = Column(BigInteger, primary_key=True)
+    message_count = Column(Integer, nullable=False, default=0)
+
+class DailyAssistantStats(Base):
+    """Сообщения пользователей по ассистентам за день (объем и популярность)."""
+    __tablename__ = "daily_assistant_stats"
+    day = Column(Date, primary_key=True)
+    assistant_slug = Column(String, primary_key=True)
+    message_count = Column(Integer, nullable=False, default=0)
+
+class DailyAssistantUser(Base):
+    """
+    Сколько сообщений пользователь отправил ассистенту за день
+    (точные уникальные по ассистентам без скана messages).
+    """
+    __tablename__ = "daily_assistant_users"
+    day = Column(Date, primary_key=True)
+    assistant_slug = Column(String, primary_key=True)
+    user_id = Column(BigInteger, primary_key=True)
+    message_count = Column(Integer, nullable=False, default=0)
+
+class RollupState(Base):
+    """High-water mark агрегации: до какого id события уже учтены."""
+    __tablename__ = "rollup_state"
+    name = Column(String, primary_key=True)  # "messages"
+    last_id = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=get_current_time)
+
+class UserCohort(Base):
+    """
+    Когорта пользователя (день регистрации) и самый дальний день активности
+    относительно нее: last_day_n = 7 значит, что пользователь писал на 7-й день или позже.
+    """
+    __tablename__ = "user_cohorts"
+    user_id = Column(BigInteger, primary_key=True)
+    cohort_day = Column(Date, nullable=False, index=True)
+    last_day_n = Column(Integer, nullable=False, default=-1)  # -1: еще ни одного сообщения
+
+class CohortRetention(Base):
+    """
+    Матрица удержания: сколько пользователей когорты были активны в период n.
+    period="day": когорта — день регистрации, n — день от регистрации (0 — тот же день).
+    period="week": когорта — неделя регистрации (с понедельника), n — неделя от нее.
+    """
+    __tablename__ = "cohort_retention"
+    period = Column(String, primary_key=True)
+    cohort_start = Column(Date, primary_key=True)
+    n = Column(Integer, primary_key=True)
+    users = Column(Integer, nullable=False, default=0)
+
+class DailySketch(Base):
+    """
+    HyperLogLog-скетч уникальных пользователей за день (app/hll.py).
+    scope="all" — все сообщения, "assistant:<slug>" — сообщения одному ассистенту.
+    Скетчи за несколько дней объединяются, так что уникальных можно оценить за любое окно.
+    """
+    __tablename__ = "daily_sketches"
+    day = Column(Date, primary_key=True)
+    scope = Column(String, primary_key=True)
+    registers = Column(LargeBinary, nullable=False)
+
+class DailyAdStats(Base):
+    """
+    Рекламная воронка за день по товару и ассистенту: показы, клики и
+    задержка от показа до клика (сумма и число кликов, для которых нашелся показ).
+    assistant_slug="" — ассистент неизвестен (клики до появления метки в ссылке).
+    """
+    __tablename__ = "daily_ad_stats"
+    day = Column(Date, primary_key=True)
+    product_id = Column(Integer, primary_key=True)
+    assistant_slug = Column(String, primary_key=True)
+    impressions = Column(Integer, nullable=False, default=0)
+    clicks = Column(Integer, nullable=False, default=0)
+    attributed_clicks = Column(Integer, nullable=False, default=0)
+    latency_seconds = Column(Float, nullable=False, default=0)
@@ -0,0 +1,88 @@
+import hashlib
+import json
+from dataclasses import dataclass, asdict
+from sqlalchemy.future import select
+from app.config import settings
+from app.database import ReadSessionLocal
+from app.cache import VersionedCache
+from app.models import Assistant
+
+@dataclass(frozen=True)
+class AssistantInfo:
+    """Снимок ассистента для кэша (поля те же, что отдает /api/assistants)."""
+    slug: str
+    name: str | None
+    description: str | None
+    icon_emoji: str | None
+    openrouter_preset: str | None
+    welcome_message: str | None
+    is_active: bool | None
+
+class AssistantRegistry(VersionedCache):
+    """
+    Реестр ассистентов в памяти процесса.
+
+    Чат берет из него пресет OpenRouter без запроса в БД, а /api/assistants
+    отдает заранее сериализованный JSON с ETag: повторное открытие Mini App
+    получает 304 без обращения к базе.
+    Ассистенты меняются только через AssistantAdmin и sync_google —
+    они и сбрасывают кэш через invalidate().
+    """
+
+    def __init__(self, ttl: int):
+        super().__init__(ttl)
+        self._by_slug: dict[str, AssistantInfo] = {}
+        self.active_body = b"[]"
+        self.etag = '""'
+
+    async def load(self):
+        async with ReadSessionLocal() as session:
+            result = await session.execute(select(Assistant))
+            assistants = result.scalars().all()
+
+        by_slug = {
+            a.slug: AssistantInfo(
+                slug=a.slug,
+                name=a.name,
+                description=a.description,
+                icon_emoji=a.icon_emoji,
+                openrouter_preset=a.openrouter_preset,
+                welcome_message=a.welcome_message,
+                is_active=a.is_active,
+            )
+            for a in assistants
+        }
+        body = json.dumps(
+            [asdict(info) for info in by_slug.values() if info.is_active],
+            ensure_ascii=False,
+            separators=(",", ":"),
+        ).encode("utf-8")
+
+        # ETag зависит только от содержимого: после перезапуска или в другом
+        # воркере тот же список дает тот же ETag
+        self._by_slug = by_slug
+        self.active_body = body
+        self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+
+    async def get(self, slug: str) -> AssistantInfo | None:
+        await self.ensure_loaded()
+        return self._by_slug.get(slug)
+
+    async def get_active_payload(self) -> tuple[bytes, str]:
+        """(JSON-список активных ассистентов, его ETag)."""
+        await self.ensure_loaded()
+        return self.active_body, self.etag
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Проверка заголовка If-None-Match (список через запятую, W/-префиксы, "*")."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == "*" or candidate == etag:
+            return True
+    return False
+
+assistant_registry = AssistantRegistry(ttl=settings.ASSISTANT_REGISTRY_TTL)
@@ -0,0 +1,128 @@
+import math
+import re
+from collections import Counter
+
+# Служебные слова, которые не несут смысла для подбора товара
+STOP_WORDS = frozenset("""
+и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне было вот
+от меня еще нет о из ему теперь когда даже ну вдруг ли если уже или ни быть был него до вас нибудь опять
+уж вам ведь там потом себя ничего ей может они тут где есть надо ней для мы тебя их чем была сам чтоб без
+будто чего раз тоже себе под будет ж тогда кто этот того потому этого какой совсем ним здесь этом один почти
+мой тем чтобы нее сейчас были куда зачем всех никогда можно при наконец два об другой хоть после над больше
+тот через эти нас про всего них какая много разве три эту моя впрочем хорошо свою этой перед иногда лучше чуть
+том нельзя такой им более всегда конечно всю между это очень привет спасибо пожалуйста
+""".split())
+
+# Окончания для облегченного стемминга (сначала длинные)
+_ENDINGS = sorted(set("""
+иями ями ами ией иях ях ах ов ев ей ий ый ой ая яя ое ее ые ие ого его ому ему ыми ими ую юю ом ем ам
+ться тся ешь ете ите ует уют ает ают яет яют ишь ит ат ят ут ют ть им ым
+ость ости ение ения ению ением ании ание а я о е ы и у ю ь й
+""".split()), key=len, reverse=True)
+
+_MIN_STEM = 3
+_TOKEN_RE = re.compile(r"[a-zа-яё0-9]+")
+
+def stem(word: str) -> str:
+    """Облегченный стеммер для русского: отрезает самое длинное подходящее окончание."""
+    if not re.match(r"[а-я]", word):
+        return word
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= _MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+def tokenize(text: str | None) -> list[str]:
+    if not text:
+        return []
+    words = _TOKEN_RE.findall(text.lower().replace("ё", "е"))
+    return [stem(w) for w in words if len(w) > 1 and w not in STOP_WORDS]
+
+class RelevanceIndex:
+    """
+    Инвертированный индекс по товарам каталога со скорингом BM25.
+
+    Ключевые слова товара весят больше рекламного текста: они попадают
+    в документ дважды (упрощенный BM25F).
+
+    Порог отсечения применяется не к сырому BM25: его масштаб зависит от idf,
+    то есть от размера каталога (в каталоге из одного товара idf ~0.29)
+    и от того, у скольких товаров есть термин (общий для всех товаров
+    ключ дает idf ~0). Поэтому вклад каждого термина делится на максимально
+    возможный для него (weight * idf * (K1 + 1)) — остается насыщение tf
+    от 0 до 1, умноженное на вес термина в запросе. Сумма этих долей
+    (match) сравнивается с порогом, а BM25 только ранжирует.
+    """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, products):
+        self.postings: dict[str, dict[int, int]] = {}
+        self.doc_len: dict[int, int] = {}
+
+        for p in products:
+            terms = tokenize(p.keywords) * 2 + tokenize(p.name) + tokenize(p.ad_text)
+            self.doc_len[p.id] = len(terms)
+            for term, tf in Counter(terms).items():
+                self.postings.setdefault(term, {})[p.id] = tf
+
+        self.n_docs = len(self.doc_len)
+        self.avg_len = (sum(self.doc_len.values()) / self.n_docs) if self.n_docs else 0.0
+
+    def idf(self, term: str) -> float:
+        n = len(self.postings.get(term, ()))
+        return math.log(1 + (self.n_docs - n + 0.5) / (n + 0.5))
+
+    def score(self, query: dict[str, float], allowed_ids=None) -> dict[int, float]:
+        """
+        query: термин -> вес (например, свежее сообщение весит больше истории).
+        Возвращает product_id -> score только для товаров с совпадениями.
+        """
+        return self.score_and_match(query, allowed_ids)[0]
+
+    def score_and_match(self, query: dict[str, float], allowed_ids=None) -> tuple[dict[int, float], dict[int, float]]:
+        """
+        То же, что score, плюс product_id -> match: сумма по совпавшим терминам
+        weight * tf * (K1 + 1) / (tf + K1 * norm) / (K1 + 1) — BM25 без idf,
+        деленный на максимум. Не зависит от размера каталога и частоты термина.
+        """
+        scores: dict[int, float] = {}
+        matches: dict[int, float] = {}
+        for term, weight in query.items():
+            docs = self.postings.get(term)
+            if not docs:
+                continue
+            idf = self.idf(term)
+            for pid, tf in docs.items():
+                if allowed_ids is not None and pid not in allowed_ids:
+                    continue
+                norm = 1 - self.B + self.B * self.doc_len[pid] / self.avg_len
+                saturation = weight * tf / (tf + self.K1 * norm)
+                scores[pid] = scores.get(pid, 0.0) + idf * saturation * (self.K1 + 1)
+                matches[pid] = matches.get(pid, 0.0) + saturation
+        return scores, matches
+
+    def top_k(self, query: dict[str, float], products, k: int, min_score: float) -> list:
+        """Лучшие по BM25 k товаров из products, у которых match не меньше min_score."""
+        by_id = {p.id: p for p in products}
+        scores, matches = self.score_and_match(query, allowed_ids=by_id.keys())
+        ranked = sorted(
+            (pid for pid, m in matches.items() if m >= min_score),
+            key=lambda pid: (-scores[pid], pid)
+        )
+        return [by_id[pid] for pid in ranked[:k]]
+
+def build_query(user_text: str, history: list, history_weight: float = 0.5, history_depth: int = 4) -> dict[str, float]:
+    """
+    Запрос для ранжирования: текущее сообщение пользователя плюс
+    несколько его предыдущих сообщений с меньшим весом.
+    """
+    query: dict[str, float] = {}
+    recent = [msg.content for msg in history if msg.role == "user"][-history_depth:]
+    for text in recent:
+        for term in set(tokenize(text)):
+            query[term] = max(query.get(term, 0.0), history_weight)
+    for term in set(tokenize(user_text)):
+        query[term] = 1.0
+    return query
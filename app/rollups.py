@@ -0,0 +1,429 @@
+import asyncio
+from collections import Counter, defaultdict
+from itertools import takewhile
+from datetime import date, timedelta
+from sqlalchemy import select, update, bindparam, func
+from app.config import settings
+from app.database import engine, dialect_insert
+from app.hll import HyperLogLog
+from app.models import (
+    User, Message, DailyUserActivity, DailyAssistantStats, DailyAssistantUser, RollupState,
+    UserCohort, CohortRetention, DailySketch, AdImpression, UserClick, DailyAdStats,
+    get_current_time,
+)
+
+# Области скетчей уникальных пользователей (daily_sketches.scope)
+SKETCH_ALL = "all"
+SKETCH_ASSISTANT_PREFIX = "assistant:"
+
+def assistant_scope(slug: str) -> str:
+    return SKETCH_ASSISTANT_PREFIX + slug
+
+# Рекламная воронка: ключ daily_ad_stats; ассистент неизвестен у старых кликов без метки
+AD_STATS_KEYS = ["day", "product_id", "assistant_slug"]
+UNKNOWN_ASSISTANT = ""
+
+class RollupConflict(Exception):
+    """High-water mark сдвинул кто-то другой (второй воркер) — пачку откатываем."""
+
+def upsert_add(conn, table, keys: list[str], rows: list[dict]):
+    """INSERT ... ON CONFLICT (keys) DO UPDATE SET x = x + excluded.x для всех не-ключевых колонок rows."""
+    stmt = dialect_insert(conn, table)
+    values = [column for column in rows[0] if column not in keys]
+    stmt = stmt.on_conflict_do_update(
+        index_elements=keys,
+        set_={column: table.c[column] + stmt.excluded[column] for column in values},
+    )
+    return conn.execute(stmt, rows)
+
+def week_start(day: date) -> date:
+    """Понедельник недели, в которую попадает day."""
+    return day - timedelta(days=day.weekday())
+
+# --- Когорты удержания ---
+# Вся арифметика дат делается в Python, поэтому одинаково работает на SQLite и PostgreSQL.
+
+_raise_last_day_n = (
+    update(UserCohort.__table__)
+    .where(UserCohort.__table__.c.user_id == bindparam("uid"))
+    .where(UserCohort.__table__.c.last_day_n < bindparam("day_n"))
+    .values(last_day_n=bindparam("day_n"))
+)
+
+async def sync_user_cohorts(conn, user_ids: set[int] | None = None):
+    """Заводит когорту (день регистрации) пользователям, которых еще нет в user_cohorts."""
+    query = (
+        select(User.tg_id, User.created_at)
+        .outerjoin(UserCohort, UserCohort.user_id == User.tg_id)
+        .where(UserCohort.user_id.is_(None))
+    )
+    if user_ids is not None:
+        query = query.where(User.tg_id.in_(user_ids))
+    rows = (await conn.execute(query)).all()
+    if not rows:
+        return
+
+    today = get_current_time().date()
+    stmt = dialect_insert(conn, UserCohort.__table__).on_conflict_do_nothing(index_elements=["user_id"])
+    await conn.execute(stmt, [
+        {"user_id": user_id, "cohort_day": created_at.date() if created_at else today, "last_day_n": -1}
+        for user_id, created_at in rows
+    ])
+
+async def apply_cohorts(conn, pairs: set[tuple[date, int]]):
+    """
+    Учитывает в матрице удержания пары (день, пользователь) из новой пачки сообщений.
+    Вызывается до записи пачки в daily_user_activity: по ней видно, какие пары
+    (и недели) у пользователя уже были посчитаны раньше.
+    """
+    user_ids = {user_id for _, user_id in pairs}
+    await sync_user_cohorts(conn, user_ids)
+    cohorts = dict((await conn.execute(
+        select(UserCohort.user_id, UserCohort.cohort_day).where(UserCohort.user_id.in_(user_ids))
+    )).all())
+
+    days = [day for day, _ in pairs]
+    first, last = week_start(min(days)), week_start(max(days)) + timedelta(days=6)
+    seen = set((await conn.execute(
+        select(DailyUserActivity.day, DailyUserActivity.user_id)
+        .where(DailyUserActivity.user_id.in_(user_ids))
+        .where(DailyUserActivity.day >= first, DailyUserActivity.day <= last)
+    )).all())
+    active_weeks = {(user_id, week_start(day)) for day, user_id in seen}
+
+    cells: Counter = Counter()
+    last_day_n: dict[int, int] = {}
+    for day, user_id in sorted(pairs):
+        cohort_day = cohorts.get(user_id)
+        if (day, user_id) in seen or cohort_day is None:
+            continue
+        day_n = (day - cohort_day).days
+        if day_n < 0:
+            continue
+        cells[("day", cohort_day, day_n)] += 1
+
+        week = week_start(day)
+        if (user_id, week) not in active_weeks:
+            active_weeks.add((user_id, week))
+            cohort_week = week_start(cohort_day)
+            cells[("week", cohort_week, (week - cohort_week).days // 7)] += 1
+
+        last_day_n[user_id] = max(last_day_n.get(user_id, -1), day_n)
+
+    if cells:
+        await upsert_add(conn, CohortRetention.__table__, ["period", "cohort_start", "n"], [
+            {"period": period, "cohort_start": start, "n": n, "users": users}
+            for (period, start, n), users in cells.items()
+        ])
+    if last_day_n:
+        await conn.execute(_raise_last_day_n, [{"uid": uid, "day_n": n} for uid, n in last_day_n.items()])
+
+# --- Скетчи уникальных пользователей ---
+
+async def apply_sketches(conn, users_by_key: dict[tuple[date, str], set[int]]):
+    """
+    Добавляет пользователей пачки в дневные HyperLogLog-скетчи (день, область).
+    Добавление идемпотентно, поэтому переписываются только скетчи, у которых изменился хоть один регистр.
+    """
+    days = {day for day, _ in users_by_key}
+    scopes = {scope for _, scope in users_by_key}
+    existing = {
+        (day, scope): registers
+        for day, scope, registers in (await conn.execute(
+            select(DailySketch.day, DailySketch.scope, DailySketch.registers)
+            .where(DailySketch.day.in_(days), DailySketch.scope.in_(scopes))
+        )).all()
+    }
+
+    rows = []
+    for key, user_ids in users_by_key.items():
+        stored = existing.get(key)
+        sketch = HyperLogLog.from_bytes(stored) if stored is not None else HyperLogLog()
+        before = bytes(sketch.registers)
+        sketch.update(user_ids)
+        if stored is None or sketch.registers != before:
+            rows.append({"day": key[0], "scope": key[1], "registers": sketch.to_bytes()})
+
+    if rows:
+        stmt = dialect_insert(conn, DailySketch.__table__)
+        await conn.execute(
+            stmt.on_conflict_do_update(index_elements=["day", "scope"], set_={"registers": stmt.excluded.registers}),
+            rows,
+        )
+
+class IncrementalRollup:
+    """
+    Инкрементальная агрегация таблицы событий по high-water mark.
+
+    Обрабатывает только строки с id больше сохраненного HWM, пачками по
+    chunk_size. Агрегаты и новый HWM пишутся в одной транзакции, а HWM
+    обновляется условно (WHERE last_id = прочитанный), так что пачка
+    не посчитается дважды, даже если задача запущена в нескольких воркерах.
+    Удаление событий в админке агрегаты не уменьшает: это статистика
+    того, что происходило.
+
+    settle_seconds > 0 нужен там, где id из последовательности коммитятся
+    не по порядку (PostgreSQL: транзакция с id 104 может закоммититься после
+    транзакции с id 105, и HWM перескочил бы 104 навсегда). Тогда пачка
+    обрывается на первом событии моложе settle_seconds: к этому времени все
+    транзакции, взявшие меньшие id, уже закоммичены. В SQLite запись одна
+    на всю базу, и id видны строго по порядку.
+    """
+
+    NAME = ""
+
+    def __init__(self, chunk_size: int, settle_seconds: float = 0.0):
+        self.chunk_size = chunk_size
+        self.settle_seconds = settle_seconds
+
+    async def _read_hwm(self, conn) -> int:
+        last_id = (await conn.execute(
+            select(RollupState.last_id).where(RollupState.name == self.NAME)
+        )).scalar()
+        if last_id is not None:
+            return last_id
+
+        await conn.execute(
+            dialect_insert(conn, RollupState.__table__)
+            .values(name=self.NAME, last_id=0, updated_at=get_current_time())
+            .on_conflict_do_nothing(index_elements=["name"])
+        )
+        return (await conn.execute(
+            select(RollupState.last_id).where(RollupState.name == self.NAME)
+        )).scalar()
+
+    def _select(self, last_id: int):
+        """Следующая пачка событий после last_id, по возрастанию id."""
+        raise NotImplementedError
+
+    async def _apply(self, conn, rows):
+        raise NotImplementedError
+
+    async def _run_chunk(self) -> int:
+        async with engine.begin() as conn:
+            last_id = await self._read_hwm(conn)
+            rows = (await conn.execute(self._select(last_id).limit(self.chunk_size))).all()
+            if self.settle_seconds:
+                cutoff = get_current_time() - timedelta(seconds=self.settle_seconds)
+                # Непрерывный префикс по id, а не фильтр по времени: иначе свежая строка
+                # с меньшим id осталась бы позади HWM
+                rows = list(takewhile(lambda row: row.created_at is None or row.created_at <= cutoff, rows))
+            if not rows:
+                return 0
+
+            await self._apply(conn, rows)
+
+            result = await conn.execute(
+                update(RollupState)
+                .where(RollupState.name == self.NAME, RollupState.last_id == last_id)
+                .values(last_id=rows[-1].id, updated_at=get_current_time())
+            )
+            if result.rowcount != 1:
+                raise RollupConflict()
+        return len(rows)
+
+    async def catch_up(self) -> int:
+        """Догоняет агрегаты до последнего события. Возвращает число обработанных событий."""
+        processed = 0
+        try:
+            while True:
+                n = await self._run_chunk()
+                processed += n
+                if n < self.chunk_size:
+                    break
+        except RollupConflict:
+            pass
+        return processed
+
+class MessageRollup(IncrementalRollup):
+    """
+    Сообщения -> дневные таблицы для дашборда (daily_user_activity,
+    daily_assistant_stats, daily_assistant_users), скетчи уникальных пользователей (daily_sketches)
+    и матрица удержания по когортам (user_cohorts, cohort_retention).
+    """
+
+    NAME = "messages"
+
+    def _select(self, last_id: int):
+        return (
+            select(Message.id, Message.user_id, Message.assistant_slug, Message.role, Message.created_at)
+            .where(Message.id > last_id)
+            .order_by(Message.id)
+        )
+
+    async def _apply(self, conn, rows):
+        users: Counter = Counter()
+        assistants: Counter = Counter()
+        assistant_users: Counter = Counter()
+        sketches: defaultdict = defaultdict(set)
+        for row in rows:
+            # Метрики дашборда считаются по сообщениям пользователей
+            if row.role != "user" or row.created_at is None:
+                continue
+            day = row.created_at.date()
+            # messages.assistant_slug допускает NULL, а в ключах агрегатов он обязателен
+            slug = row.assistant_slug or UNKNOWN_ASSISTANT
+            users[(day, row.user_id)] += 1
+            assistants[(day, slug)] += 1
+            assistant_users[(day, slug, row.user_id)] += 1
+            sketches[(day, SKETCH_ALL)].add(row.user_id)
+            sketches[(day, assistant_scope(slug))].add(row.user_id)
+
+        if users:
+            # Когорты — до записи дневной активности, чтобы отличить новые пары от уже учтенных
+            await apply_cohorts(conn, set(users))
+            await upsert_add(conn, DailyUserActivity.__table__, ["day", "user_id"], [
+                {"day": day, "user_id": user_id, "message_count": n}
+                for (day, user_id), n in users.items()
+            ])
+        if assistants:
+            await upsert_add(conn, DailyAssistantStats.__table__, ["day", "assistant_slug"], [
+                {"day": day, "assistant_slug": slug, "message_count": n}
+                for (day, slug), n in assistants.items()
+            ])
+        if assistant_users:
+            await upsert_add(conn, DailyAssistantUser.__table__, ["day", "assistant_slug", "user_id"], [
+                {"day": day, "assistant_slug": slug, "user_id": user_id, "message_count": n}
+                for (day, slug, user_id), n in assistant_users.items()
+            ])
+        if sketches:
+            await apply_sketches(conn, sketches)
+
+    async def catch_up(self) -> int:
+        # Когорты нужны и тем, кто еще ничего не написал (знаменатель удержания)
+        async with engine.begin() as conn:
+            await sync_user_cohorts(conn)
+        return await super().catch_up()
+
+class AdImpressionRollup(IncrementalRollup):
+    """Журнал показов (ad_impressions) -> показы в daily_ad_stats."""
+
+    NAME = "ad_impressions"
+
+    def _select(self, last_id: int):
+        return (
+            select(AdImpression.id, AdImpression.product_id, AdImpression.assistant_slug, AdImpression.created_at)
+            .where(AdImpression.id > last_id)
+            .order_by(AdImpression.id)
+        )
+
+    async def _apply(self, conn, rows):
+        impressions: Counter = Counter(
+            (row.created_at.date(), row.product_id, row.assistant_slug or UNKNOWN_ASSISTANT)
+            for row in rows if row.created_at is not None and row.product_id is not None
+        )
+        if impressions:
+            await upsert_add(conn, DailyAdStats.__table__, AD_STATS_KEYS, [
+                {"day": day, "product_id": pid, "assistant_slug": slug, "impressions": n}
+                for (day, pid, slug), n in impressions.items()
+            ])
+
+class AdClickRollup(IncrementalRollup):
+    """
+    Клики (user_clicks) -> клики в daily_ad_stats и задержка от показа до клика.
+    Клику сопоставляется последний показ того же товара тому же пользователю
+    (не старше attribution_window секунд) прямо из журнала ad_impressions.
+    """
+
+    NAME = "user_clicks"
+
+    def __init__(self, chunk_size: int, attribution_window: int, settle_seconds: float = 0.0):
+        super().__init__(chunk_size, settle_seconds)
+        self.attribution_window = attribution_window
+
+    def _select(self, last_id: int):
+        # Индекс ix_ad_impressions_user_product_time: поиск идет по индексу, а не сканом журнала
+        last_shown = (
+            select(func.max(AdImpression.created_at))
+            .where(
+                AdImpression.user_id == UserClick.user_id,
+                AdImpression.product_id == UserClick.product_id,
+                AdImpression.created_at <= UserClick.created_at,
+            )
+            .scalar_subquery()
+        )
+        return (
+            select(UserClick.id, UserClick.product_id, UserClick.assistant_slug, UserClick.created_at,
+                   last_shown.label("shown_at"))
+            .where(UserClick.id > last_id)
+            .order_by(UserClick.id)
+        )
+
+    async def _apply(self, conn, rows):
+        stats: defaultdict = defaultdict(lambda: [0, 0, 0.0])  # key -> [clicks, attributed, latency]
+        for row in rows:
+            if row.created_at is None or row.product_id is None:
+                continue
+            cell = stats[(row.created_at.date(), row.product_id, row.assistant_slug or UNKNOWN_ASSISTANT)]
+            cell[0] += 1
+            if row.shown_at is not None:
+                latency = (row.created_at - row.shown_at).total_seconds()
+                if 0 <= latency <= self.attribution_window:
+                    cell[1] += 1
+                    cell[2] += latency
+
+        if stats:
+            await upsert_add(conn, DailyAdStats.__table__, AD_STATS_KEYS, [
+                {"day": day, "product_id": pid, "assistant_slug": slug,
+                 "clicks": clicks, "attributed_clicks": attributed, "latency_seconds": latency}
+                for (day, pid, slug), (clicks, attributed, latency) in stats.items()
+            ])
+
+class RollupJob:
+    """
+    Фоновая задача, которая раз в interval секунд догоняет все агрегаты по очереди.
+    run() можно вызвать и напрямую (дашборд перед расчетом метрик).
+    Ошибка одного агрегата не останавливает остальные: она печатается,
+    а его HWM остается на месте до следующего прогона.
+    """
+
+    def __init__(self, interval: float, rollups: list[IncrementalRollup]):
+        self.interval = interval
+        self.rollups = rollups
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    async def run(self) -> dict[str, int]:
+        """Возвращает число обработанных событий по каждому агрегату (0 у упавших)."""
+        processed = {}
+        async with self._lock:
+            for rollup in self.rollups:
+                try:
+                    processed[rollup.NAME] = await rollup.catch_up()
+                except Exception as e:
+                    print(f"Rollup error ({rollup.NAME}): {e}")
+                    processed[rollup.NAME] = 0
+        return processed
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run()
+            except Exception as e:
+                print(f"Rollup error: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        # Отмена безопасна: пачка и HWM пишутся одной транзакцией и откатятся вместе
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+# Выдержка нужна только при нескольких параллельных писателях с последовательностями
+_settle = settings.ROLLUP_SETTLE_SECONDS if engine.dialect.name == "postgresql" else 0.0
+
+rollup_job = RollupJob(interval=settings.ROLLUP_INTERVAL, rollups=[
+    MessageRollup(chunk_size=settings.ROLLUP_CHUNK_SIZE, settle_seconds=_settle),
+    # Показы раньше кликов, чтобы в свежем дне клики не опережали показы (CTR > 100%)
+    AdImpressionRollup(chunk_size=settings.ROLLUP_CHUNK_SIZE, settle_seconds=_settle),
+    AdClickRollup(
+        chunk_size=settings.ROLLUP_CHUNK_SIZE,
+        attribution_window=settings.AD_ATTRIBUTION_WINDOW,
+        settle_seconds=_settle,
+    ),
+])
@@ -0,0 +1,233 @@
+import asyncio
+import time
+import httpx
+from sqlalchemy import update
+from app.config import settings
+from app.writes import write_coordinator
+from app.models import User
+
+SALEBOT_API_URL = "https://chatter.salebot.pro/api"
+
+# Один HTTP-клиент на все время жизни приложения: keep-alive соединения
+# переиспользуются, без нового TCP+TLS рукопожатия на каждый вызов
+_http_client: httpx.AsyncClient | None = None
+
+def get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=settings.SALEBOT_TIMEOUT,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        )
+    return _http_client
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+class SalebotIdResolver:
+    """
+    Склеивает параллельные запросы Salebot ID от разных пользователей
+    в один вызов load_clients (он принимает список клиентов).
+
+    Первый запрос открывает окно в window секунд; все, кто пришел за это
+    время (но не больше max_batch), уходят одним HTTP-запросом.
+    Повторные запросы одного и того же tg_id в окне сливаются.
+    Если в ответе на пачку есть клиенты без platform_id, их нельзя
+    сопоставить с запросами — такие tg_id переспрашиваются по одному.
+    """
+
+    def __init__(self, window: float, max_batch: int):
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: dict[str, list[asyncio.Future]] = {}
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def resolve(self, tg_id: int) -> str | None:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.setdefault(str(tg_id), []).append(future)
+
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        # Держим ссылку на задачу, иначе ее может собрать GC до завершения
+        task = asyncio.create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _load(self, platform_ids: list[str]) -> tuple[dict[str, str], list[str]]:
+        """
+        Один вызов load_clients. Возвращает platform_id -> ID клиента и ID тех
+        клиентов, для которых Salebot не вернул platform_id.
+        """
+        url = f"{SALEBOT_API_URL}/{settings.SALEBOT_API_KEY}/load_clients"
+        response = await get_http_client().post(url, json=[
+            {
+                "platform_id": platform_id,
+                "client_type": 0 # 0 - стандартный тип для мессенджеров
+            }
+            for platform_id in platform_ids
+        ])
+        response.raise_for_status()
+
+        found: dict[str, str] = {}
+        anonymous: list[str] = []
+        for client in response.json().get("clients") or []:
+            platform_id = client.get("platform_id")
+            if platform_id is not None:
+                found[str(platform_id)] = str(client["id"])
+            else:
+                anonymous.append(str(client["id"]))
+        return found, anonymous
+
+    async def _load_one(self, platform_id: str) -> str | None:
+        found, anonymous = await self._load([platform_id])
+        # Без platform_id однозначно сопоставить можно только единственного запрошенного
+        return found.get(platform_id) or (anonymous[0] if anonymous else None)
+
+    async def _send(self, batch: dict[str, list[asyncio.Future]]):
+        results: dict[str, str | BaseException | None] = {}
+        try:
+            if len(batch) == 1:
+                platform_id = next(iter(batch))
+                results[platform_id] = await self._load_one(platform_id)
+            else:
+                found, anonymous = await self._load(list(batch))
+                results.update(found)
+                missing = [platform_id for platform_id in batch if platform_id not in found]
+                if anonymous and missing:
+                    # Клиентов без platform_id нельзя раздать ждущим, и "не найден" им
+                    # отвечать нельзя (попадут в негативный кэш): переспрашиваем по одному
+                    print(f"Salebot load_clients: {len(anonymous)} clients without platform_id, resolving {len(missing)} one by one")
+                    single = await asyncio.gather(*(self._load_one(platform_id) for platform_id in missing), return_exceptions=True)
+                    results.update(zip(missing, single))
+        except Exception as e:
+            # Ошибку отдаем всем ждущим: "Salebot недоступен" не то же самое, что "клиент не найден"
+            results = {platform_id: e for platform_id in batch}
+
+        for platform_id, futures in batch.items():
+            result = results.get(platform_id)
+            for future in futures:
+                if future.done():
+                    continue
+                if isinstance(result, BaseException):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+salebot_resolver = SalebotIdResolver(
+    window=settings.SALEBOT_BATCH_WINDOW,
+    max_batch=settings.SALEBOT_BATCH_SIZE,
+)
+
+async def fetch_salebot_id(tg_id: int) -> str | None:
+    """
+    Запрашивает у Salebot внутренний ID клиента по его Telegram ID.
+    Запросы разных пользователей склеиваются в один load_clients.
+    """
+    if not settings.SALEBOT_API_KEY:
+        return None
+
+    try:
+        return await salebot_resolver.resolve(tg_id)
+    except Exception as e:
+        print(f"Error fetching salebot_id: {e}")
+        return None
+
+
+async def move_client_to_block(salebot_client_id: str, block_id: str):
+    """
+    Фоновая задача: перекидывает клиента в нужный блок конструктора.
+    """
+    if not settings.SALEBOT_API_KEY or not salebot_client_id:
+        return
+
+    url = f"{SALEBOT_API_URL}/{settings.SALEBOT_API_KEY}/callback"
+
+    try:
+        await get_http_client().post(url, json={
+            "client_id": salebot_client_id,
+            "message_id": block_id
+        })
+    except Exception as e:
+        print(f"Error calling Salebot callback: {e}")
+
+class SalebotLinker:
+    """
+    Привязка пользователя к Salebot в фоне, вне критического пути /api/chat.
+
+    Если salebot_id еще неизвестен, запускается фоновая задача: узнать ID,
+    сохранить его в users и сразу перекинуть клиента в целевой блок.
+    Пользователи, которых Salebot не знает, запоминаются на negative_ttl
+    секунд, чтобы не спрашивать о них на каждом сообщении.
+    """
+
+    # При таком размере негативного кэша из него вычищаются просроченные записи
+    PRUNE_SIZE = 10000
+
+    def __init__(self, negative_ttl: int):
+        self.negative_ttl = negative_ttl
+        self._unknown: dict[int, float] = {}  # tg_id -> когда можно спросить снова
+        self._in_flight: set[int] = set()
+        self._tasks: set[asyncio.Task] = set()
+
+    def link_in_background(self, tg_id: int):
+        if not settings.SALEBOT_API_KEY or tg_id in self._in_flight:
+            return
+        retry_at = self._unknown.get(tg_id)
+        if retry_at is not None and time.monotonic() < retry_at:
+            return
+
+        self._in_flight.add(tg_id)
+        task = asyncio.create_task(self._link(tg_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _remember_unknown(self, tg_id: int):
+        now = time.monotonic()
+        if len(self._unknown) >= self.PRUNE_SIZE:
+            self._unknown = {k: v for k, v in self._unknown.items() if v > now}
+        self._unknown[tg_id] = now + self.negative_ttl
+
+    async def _link(self, tg_id: int):
+        try:
+            # Ошибка сети/API вылетит исключением и не попадет в негативный кэш
+            found_id = await salebot_resolver.resolve(tg_id)
+            if not found_id:
+                self._remember_unknown(tg_id)
+                return
+            self._unknown.pop(tg_id, None)
+
+            # Сохраняем в БД навсегда
+            await write_coordinator.submit(
+                lambda conn: conn.execute(update(User).where(User.tg_id == tg_id).values(salebot_id=found_id))
+            )
+
+            await move_client_to_block(found_id, settings.SALEBOT_TARGET_BLOCK_ID)
+        except Exception as e:
+            print(f"Salebot link error (tg_id={tg_id}): {e}")
+        finally:
+            self._in_flight.discard(tg_id)
+
+    async def stop(self):
+        """Отменяет незавершенные фоновые привязки (перед закрытием HTTP-клиента)."""
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+salebot_linker = SalebotLinker(negative_ttl=settings.SALEBOT_NEGATIVE_TTL)
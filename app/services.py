@@ -1,15 +1,17 @@
 from openai import AsyncOpenAI
 from app.config import settings
-from sqlalchemy.future import select
-from sqlalchemy import or_
-from app.models import Message, Product, Assistant
+from app.catalog import product_catalog, CatalogProduct
+from app.registry import assistant_registry
+from app.history import History
+from app.relevance import build_query
+from app.counters import product_counters
+from app.clicks import impression_queue
+from urllib.parse import quote
 import re
 import base64
-import httpx
 
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+def encode_image(image_data: bytes) -> str:
+    return base64.b64encode(image_data).decode('utf-8')
 
 ai_client = AsyncOpenAI(
     base_url=settings.OPENROUTER_BASE_URL,
@@ -19,50 +21,16 @@ ai_client = AsyncOpenAI(
 # Базовый URL для редиректов
 REDIRECT_BASE_URL = f"{settings.REDIRECT_BASE_URL}/api/click"
 
-async def get_products_context(assistant_slug: str, session, history: list, user_id: int = None) -> tuple[str, list[Product]]:
-    """
-    Формирует инструкцию с партнерскими товарами,
-    доступными для конкретного ассистента.
-    Возвращает (текст_инструкции, список_рекомендованных_товаров).
-    """
-    # 1. Забираем ВСЕ активные товары
-    result = await session.execute(select(Product).where(Product.is_active == True))
-    all_products = result.scalars().all()
-    
-    if not all_products:
-        return "", []
-
-    # 2. ФИЛЬТРАЦИЯ
-    allowed_products = []
-    for p in all_products:
-        # Если поле пустое — товар для всех
-        if not p.target_assistants:
-            allowed_products.append(p)
-        # Если поле заполнено, проверяем, есть ли там наш текущий assistant_slug
-        elif assistant_slug in p.target_assistants:
-            allowed_products.append(p)
-
-    if not allowed_products:
-        return "", []
-
-    # 2.1 ПРОВЕРКА: Были ли уже рекомендации в последних 10 сообщениях?
-    # Проверяем переданную историю (она уже ограничена 10 сообщениями в main.py)
-    # Важно: тут мы проверяем оригинальные ссылки, но ИИ теперь будет использовать редирект-ссылки.
-    # Поэтому лучше искать по ID товара в ссылке редиректа, но пока оставим простую проверку по имени или ID.
-    # Но для простоты пока оставим как есть - если ИИ недавно что-то рекомендовал.
-    
-    # Чтобы избежать дублей, мы можем проверить, есть ли ссылки на редирект в истории.
-    for msg in history:
-        if msg.role == "assistant" and "/api/click" in msg.content:
-             return "", []
-
-    # 3. Формируем текст только из разрешенных товаров
+def format_products_prompt(products, user_id: int = None, assistant_slug: str = None) -> str:
+    """Текст рекламной инструкции для переданных товаров."""
     products_list = []
-    for p in allowed_products:
-        # Генерируем ссылку для трекинга: /api/click?product_id=123&user_id=456
+    for p in products:
+        # Генерируем ссылку для трекинга: /api/click?product_id=123&user_id=456&assistant=medic
         tracking_link = f"{REDIRECT_BASE_URL}?product_id={p.id}"
         if user_id:
             tracking_link += f"&user_id={user_id}"
+        if assistant_slug:
+            tracking_link += f"&assistant={quote(assistant_slug)}"
         
         products_list.append(
             f"- ТОВАР: {p.name}. "
@@ -72,30 +40,65 @@ async def get_products_context(assistant_slug: str, session, history: list, user
     
     products_str = "\n".join(products_list)
     
-    prompt = (
+    return (
         f"\n[ИНСТРУКЦИЯ ПО РЕКЛАМЕ]\n"
         f"У тебя есть доступ к партнерским товарам:\n{products_str}\n"
         f"ВАЖНО: Если контекст последнего сообщения подходит, порекомендуй товар нативно. "
         f"Используй Markdown для ссылок: [Название](ССЫЛКА_ИЗ_ОПИСАНИЯ). "
         f"Не выдумывай ссылки, бери только те, что указаны выше."
     )
+
+async def get_products_context(assistant_slug: str, history: History, user_id: int = None, user_text: str = "") -> tuple[str, list[CatalogProduct]]:
+    """
+    Формирует инструкцию с партнерскими товарами,
+    доступными для конкретного ассистента.
+    В промпт попадают только AD_TOP_K самых релевантных разговору товаров
+    (или ни одного, если ничего не набрало AD_MIN_SCORE).
+    Возвращает (текст_инструкции, список_рекомендованных_товаров).
+    """
+    # 1-2. Разрешенные товары берем из кэша каталога (без запроса в БД)
+    allowed_products = await product_catalog.get_products(assistant_slug)
+
+    if not allowed_products:
+        return "", []
+
+    # 2.1 ПРОВЕРКА: Были ли уже рекомендации в последних сообщениях?
+    # Чтобы избежать дублей, смотрим, есть ли в окне истории ссылки на редирект.
+    # Флаг ведется в кэше истории при добавлении сообщений (app/history.py).
+    if history.has_recent_ad:
+        return "", []
+
+    # 3. Ранжирование: оставляем только товары, подходящие к разговору
+    if settings.AD_TOP_K > 0:
+        query = build_query(user_text, history.messages)
+        allowed_products = product_catalog.index.top_k(query, allowed_products, settings.AD_TOP_K, settings.AD_MIN_SCORE)
+        if not allowed_products:
+            return "", []
+
+    # 4. Формируем текст только из отобранных товаров
+    prompt = format_products_prompt(allowed_products, user_id, assistant_slug)
     
-    return prompt, allowed_products
+    return prompt, list(allowed_products)
 
-async def get_ai_response(user_text: str, assistant_slug: str, history: list, session, user_id: int = None, image_path: str = None):
+async def build_ai_request(user_text: str, assistant_slug: str, history: History, user_id: int = None, image_data: bytes = None) -> tuple[dict, set[int]]:
+    """
+    Собирает параметры запроса к ИИ (модель, сообщения, заголовки).
+    Используется и обычным, и потоковым ответом.
+    Работает только с кэшами в памяти, сессия БД не нужна.
+    Возвращает (параметры_запроса, id_товаров_в_промпте) — показы считаются только по ним.
+    """
     # 1. Получаем контекст товаров (рекламная инструкция)
-    ad_system_prompt, allowed_products = await get_products_context(assistant_slug, session, history, user_id)
+    ad_system_prompt, allowed_products = await get_products_context(assistant_slug, history, user_id, user_text)
     
     # 2. Получаем данные ассистента, чтобы узнать его ПРЕСЕТ
-    result = await session.execute(select(Assistant).where(Assistant.slug == assistant_slug))
-    assistant = result.scalars().first()
+    assistant = await assistant_registry.get(assistant_slug)
     
     # Если в базе есть пресет (например, "@preset/agro-v1"), используем его.
     # Если нет — используем запасную модель.
     # ВАЖНО: Если есть картинка, модель ДОЛЖНА поддерживать Vision. 
     # Если в пресете прописана модель без Vision, запрос упадет.
     # Для надежности: если есть картинка и нет пресета, берем gpt-4o.
-    model_id = assistant.openrouter_preset if assistant and assistant.openrouter_preset else ("openai/gpt-4o" if image_path else "openai/gpt-4o-mini")
+    model_id = assistant.openrouter_preset if assistant and assistant.openrouter_preset else ("openai/gpt-4o" if image_data else "openai/gpt-4o-mini")
 
     # 3. Формируем историю сообщений
     messages = []
@@ -109,12 +112,14 @@ async def get_ai_response(user_text: str, assistant_slug: str, history: list, se
             })
     
     # Добавляем историю переписки
-    for msg in history:
+    for msg in history.messages:
         messages.append({"role": msg.role, "content": msg.content})
     
     # Добавляем текущее сообщение пользователя
-    if image_path:
-        base64_image = encode_image(image_path)
+    # Картинка приходит готовыми JPEG-байтами из пайплайна обработки,
+    # без повторного чтения файла с диска
+    if image_data:
+        base64_image = encode_image(image_data)
         user_content = [
             {"type": "text", "text": user_text},
             {
@@ -128,8 +133,7 @@ async def get_ai_response(user_text: str, assistant_slug: str, history: list, se
     else:
         messages.append({"role": "user", "content": user_text})
 
-    # 4. Запрос к ИИ
-    response = await ai_client.chat.completions.create(
+    request = dict(
         model=model_id, # <-- Сюда подставляется пресет (напр. @preset/agro-v1)
         messages=messages,
         temperature=0.7,
@@ -138,75 +142,56 @@ async def get_ai_response(user_text: str, assistant_slug: str, history: list, se
             "X-Title": "Envisio"
         }
     )
-    
-    ai_content = response.choices[0].message.content
+    return request, {p.id for p in allowed_products}
 
-    # 5. Трекинг показов (Impressions)
-    # Проверяем, вставил ли ИИ ссылку на товар в свой ответ.
-    # Ищем вхождения "/api/click?product_id=X"
+def track_impressions(ai_content: str | None, product_ids: set[int], user_id: int = None, assistant_slug: str = None):
+    """
+    Трекинг показов (Impressions).
+    Проверяем, вставил ли ИИ ссылку на товар в свой ответ.
+    Ищем вхождения "/api/click?product_id=X"
+    Засчитываются только товары из промпта (product_ids): id, который ИИ выдумал
+    или исказил, не должен попасть в журнал показов (на PostgreSQL внешний ключ
+    на products отклонил бы всю пачку показов).
+    """
     if ai_content:
         # Простое регулярное выражение для поиска ID
         # Ссылка вида: .../api/click?product_id=123...
         found_ids = re.findall(r"product_id=(\d+)", ai_content)
         if found_ids:
-            unique_ids = set(found_ids)
-            for pid in unique_ids:
-                # Находим товар в allowed_products (чтобы не делать лишний запрос в БД, хотя объекты могут быть detached)
-                # Надежнее сделать update запрос
-                try:
-                    pid_int = int(pid)
-                    # Инкремент impressions
-                    product_to_update = await session.get(Product, pid_int)
-                    if product_to_update:
-                        product_to_update.impressions += 1
-                        # session.add(product_to_update) - не обязательно, если объект привязан
-                except ValueError:
-                    pass
-            # Commit будет сделан вызывающим кодом (в main.py) вместе с сохранением сообщения
+            # Счетчик пишется в БД пачкой в фоне (app/counters.py), без чтения товара,
+            # а событие показа — в журнал ad_impressions для рекламной воронки
+            for pid in {int(pid) for pid in found_ids} & product_ids:
+                product_counters.add_impression(pid)
+                impression_queue.put(user_id=user_id, product_id=pid, assistant_slug=assistant_slug)
+
+async def get_ai_response(user_text: str, assistant_slug: str, history: History, user_id: int = None, image_data: bytes = None):
+    request, product_ids = await build_ai_request(user_text, assistant_slug, history, user_id=user_id, image_data=image_data)
+
+    # 4. Запрос к ИИ
+    response = await ai_client.chat.completions.create(**request)
+    
+    ai_content = response.choices[0].message.content
+
+    # 5. Трекинг показов
+    track_impressions(ai_content, product_ids, user_id, assistant_slug)
             
     return ai_content
 
-async def fetch_salebot_id(tg_id: int) -> str | None: 
-    """ 
-    Запрашивает у Salebot внутренний ID клиента по его Telegram ID. 
-    """ 
-    if not settings.SALEBOT_API_KEY: 
-        return None 
- 
-    url = f"https://chatter.salebot.pro/api/{settings.SALEBOT_API_KEY}/load_clients" 
-     
-    async with httpx.AsyncClient() as client: 
-        try: 
-            response = await client.post(url, json=[{ 
-                "platform_id": str(tg_id), 
-                "client_type": 0 # 0 - стандартный тип для мессенджеров 
-            }]) 
-             
-            if response.status_code == 200: 
-                data = response.json() 
-                # Salebot возвращает список, берем первого клиента 
-                if "clients" in data and len(data["clients"]) > 0: 
-                    return str(data["clients"][0]["id"]) 
-        except Exception as e: 
-            print(f"Error fetching salebot_id: {e}") 
-             
-    return None 
- 
- 
-async def move_client_to_block(salebot_client_id: str, block_id: str): 
-    """ 
-    Фоновая задача: перекидывает клиента в нужный блок конструктора. 
-    """ 
-    if not settings.SALEBOT_API_KEY or not salebot_client_id: 
-        return 
- 
-    url = f"https://chatter.salebot.pro/api/{settings.SALEBOT_API_KEY}/callback" 
-     
-    async with httpx.AsyncClient() as client: 
-        try: 
-            await client.post(url, json={ 
-                "client_id": salebot_client_id, 
-                "message_id": block_id 
-            }) 
-        except Exception as e: 
-            print(f"Error calling Salebot callback: {e}")
\ No newline at end of file
+async def stream_ai_response(request: dict, product_ids: set[int], user_id: int = None, assistant_slug: str = None):
+    """
+    Потоковый ответ ИИ: отдает куски текста по мере генерации.
+    Показы считаются по полному тексту, когда поток закончился.
+    product_ids — товары из промпта (второе значение build_ai_request).
+    """
+    stream = await ai_client.chat.completions.create(**request, stream=True)
+
+    parts = []
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            parts.append(delta)
+            yield delta
+
+    track_impressions("".join(parts), product_ids, user_id, assistant_slug)
@@ -0,0 +1,160 @@
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+from sqlalchemy import event
+from app.config import settings
+
+# Сколько символов SQL показывать в логе и на дашборде
+STATEMENT_PREVIEW = 300
+
+def parameter_shape(parameters, executemany: bool) -> str:
+    """
+    Форма параметров без значений (в лог не попадают тексты сообщений и id):
+    (int, str) для одной строки, 200 x (int, str) для executemany.
+    """
+    if executemany:
+        rows = list(parameters or ())
+        if rows and isinstance(rows[0], (tuple, list, dict)):
+            return f"{len(rows)} x {parameter_shape(rows[0], False)}"
+        # insertmanyvalues (ORM add_all): executemany=True, но параметры — один плоский
+        # кортеж на все строки в одном INSERT ... VALUES (...), (...)
+        return parameter_shape(rows, False)
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{key}: {type(value).__name__}" for key, value in parameters.items()) + "}"
+    return "(" + ", ".join(type(value).__name__ for value in parameters or ()) + ")"
+
+class RequestSql:
+    """SQL одного HTTP-запроса: сколько запросов, сколько времени и какие повторялись."""
+
+    __slots__ = ("count", "seconds", "statements", "finished")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements: Counter = Counter()
+        self.finished = False
+
+    def repeated(self, threshold: int) -> list[tuple[str, int]]:
+        """Один и тот же текст запроса threshold раз и больше — похоже на N+1."""
+        return [(statement, n) for statement, n in self.statements.most_common() if n >= threshold]
+
+# SQL текущего HTTP-запроса (ставит middleware в app/main.py)
+_current: ContextVar[RequestSql | None] = ContextVar("request_sql", default=None)
+
+class SqlStats:
+    """
+    Учет SQL по эндпоинтам вместо echo=True.
+
+    События SQLAlchemy (before/after_cursor_execute) считают запросы и их время
+    в RequestSql текущего HTTP-запроса (contextvar), а запросы медленнее
+    slow_ms печатаются с формой параметров. По завершении запроса одинаковые
+    запросы, повторенные n_plus_one раз и больше, печатаются как возможный N+1.
+    Сводка по эндпоинтам — по последним window запросам каждого.
+
+    Запросы вне HTTP-запросов (агрегация, писатель app/writes.py, очереди
+    кликов) идут в общий счет "фон": записи через писателя выполняются
+    в его задаче и в счет запроса не попадают.
+    """
+
+    def __init__(self, slow_ms: float, n_plus_one: int, window: int):
+        self.slow_ms = slow_ms
+        self.n_plus_one = n_plus_one
+        self.window = window
+        # эндпоинт -> последние window запросов: (число SQL, секунды SQL, был ли N+1)
+        self._routes: dict[str, deque] = {}
+        self.background_count = 0
+        self.background_seconds = 0.0
+        self.slow = 0
+        self.slowest: deque = deque(maxlen=10)
+        self.suspects: dict[str, tuple[str, int]] = {}
+
+    def instrument(self, engine):
+        """Подписывает движок (async-обертку) на события выполнения запросов."""
+        sync_engine = engine.sync_engine
+
+        @event.listens_for(sync_engine, "before_cursor_execute")
+        def before(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault("sql_started", []).append(time.perf_counter())
+
+        @event.listens_for(sync_engine, "after_cursor_execute")
+        def after(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - conn.info["sql_started"].pop()
+            try:
+                self._record(statement, parameters, executemany, elapsed)
+            except Exception as e:
+                # Учет не должен ронять сам запрос
+                print(f"SQL stats error: {e}")
+
+        @event.listens_for(sync_engine, "handle_error")
+        def failed(exception_context):
+            started = exception_context.connection.info.get("sql_started") if exception_context.connection else None
+            if started:
+                started.pop()
+
+    def _record(self, statement: str, parameters, executemany: bool, elapsed: float):
+        current = _current.get()
+        if current is not None and not current.finished:
+            current.count += 1
+            current.seconds += elapsed
+            current.statements[statement] += 1
+        else:
+            self.background_count += 1
+            self.background_seconds += elapsed
+
+        ms = elapsed * 1000
+        if ms >= self.slow_ms:
+            self.slow += 1
+            preview = " ".join(statement.split())[:STATEMENT_PREVIEW]
+            shape = parameter_shape(parameters, executemany)
+            self.slowest.append({"ms": round(ms, 1), "statement": preview, "parameters": shape})
+            print(f"Slow SQL ({ms:.0f} ms): {preview} | params: {shape}")
+
+    def begin(self) -> RequestSql:
+        current = RequestSql()
+        _current.set(current)
+        return current
+
+    def finish(self, route: str, current: RequestSql):
+        current.finished = True
+        repeated = current.repeated(self.n_plus_one)
+        for statement, n in repeated:
+            preview = " ".join(statement.split())[:STATEMENT_PREVIEW]
+            self.suspects[route] = (preview, n)
+            print(f"Possible N+1 in {route}: {n} x {preview}")
+        history = self._routes.setdefault(route, deque(maxlen=self.window))
+        history.append((current.count, current.seconds, bool(repeated)))
+
+    def snapshot(self, top: int = 15) -> dict:
+        routes = []
+        for route, history in self._routes.items():
+            requests = len(history)
+            counts = sorted(count for count, _, _ in history)
+            seconds = sum(s for _, s, _ in history)
+            routes.append({
+                "route": route,
+                "requests": requests,
+                "avg_queries": round(sum(counts) / requests, 1),
+                "p95_queries": counts[min(int(requests * 0.95), requests - 1)],
+                "avg_ms": round(seconds / requests * 1000, 1),
+                "total_ms": round(seconds * 1000, 1),
+                "n_plus_one": sum(flag for _, _, flag in history),
+            })
+        routes.sort(key=lambda row: -row["total_ms"])
+        return {
+            "routes": routes[:top],
+            "background_queries": self.background_count,
+            "background_ms": round(self.background_seconds * 1000, 1),
+            "slow": self.slow,
+            "slow_ms": self.slow_ms,
+            "slowest": list(self.slowest),
+            "suspects": [
+                {"route": route, "statement": statement, "count": n}
+                for route, (statement, n) in self.suspects.items()
+            ],
+        }
+
+sql_stats = SqlStats(
+    slow_ms=settings.SQL_SLOW_QUERY_MS,
+    n_plus_one=settings.SQL_N_PLUS_ONE_THRESHOLD,
+    window=settings.SQL_STATS_WINDOW,
+)
@@ -0,0 +1,105 @@
+import asyncio
+from typing import Any, Awaitable, Callable
+from app.batching import STOP, collect_batch
+from app.config import settings
+from app.database import engine
+
+# Намерение записи: корутина, которая выполняет свои запросы на переданном соединении
+WriteWork = Callable[[Any], Awaitable[Any]]
+
+class WriteCoordinator:
+    """
+    Единственный писатель в БД с групповым коммитом.
+
+    Запросы не открывают собственных пишущих транзакций, а кладут намерение
+    записи в очередь. Фоновая задача берет первое намерение, добирает
+    остальные в пределах окна window секунд (не больше max_batch) и выполняет
+    их одной транзакцией: один COMMIT (и один fsync в SQLite) на всю пачку,
+    и ни один запрос не ждет блокировку записи у другого.
+
+    submit(work) по умолчанию ждет, пока пачка с этим намерением закоммитится,
+    и возвращает результат work; с wait=False намерение ставится в очередь
+    без ожидания (ошибка тогда только печатается).
+    Если пачка падает, ее намерения повторяются по одному в своих транзакциях,
+    чтобы ошибка одного не отменяла записи остальных.
+    """
+
+    def __init__(self, window: float, max_batch: int, max_queue: int):
+        self.window = window
+        self.max_batch = max_batch
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._task: asyncio.Task | None = None
+        self.batches = 0
+        self.intents = 0
+        self.errors = 0
+        self.largest_batch = 0
+
+    async def submit(self, work: WriteWork, wait: bool = True):
+        if self._task is None:
+            # Запуск по первому обращению (скрипты и тесты без lifespan приложения)
+            self.start()
+        future = asyncio.get_running_loop().create_future() if wait else None
+        # Очередь ограничена: при перегрузке запросы ждут здесь, а не копят память
+        await self._queue.put((work, future))
+        if future is not None:
+            return await future
+
+    async def _commit(self, batch: list):
+        try:
+            async with engine.begin() as conn:
+                results = [await work(conn) for work, _ in batch]
+        except Exception as e:
+            if len(batch) > 1:
+                for item in batch:
+                    await self._commit([item])
+                return
+            self.errors += 1
+            _, future = batch[0]
+            if future is None:
+                print(f"Write error: {e}")
+            elif not future.done():
+                future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.intents += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        for (_, future), result in zip(batch, results):
+            # Ожидавший запрос мог быть отменен (клиент отключился) — запись при этом уже сделана
+            if future is not None and not future.done():
+                future.set_result(result)
+
+    async def _run(self):
+        while True:
+            batch, stopping = await collect_batch(self._queue, self.window, self.max_batch)
+            if batch:
+                await self._commit(batch)
+            if stopping:
+                return
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Дописывает все, что уже в очереди, и останавливает задачу (вызывать последним из писателей)."""
+        if self._task is not None:
+            await self._queue.put(STOP)
+            await self._task
+            self._task = None
+
+    def snapshot(self) -> dict:
+        return {
+            "batches": self.batches,
+            "intents": self.intents,
+            "avg_batch": round(self.intents / self.batches, 1) if self.batches else 0.0,
+            "largest_batch": self.largest_batch,
+            "errors": self.errors,
+            "queued": self._queue.qsize(),
+        }
+
+write_coordinator = WriteCoordinator(
+    window=settings.WRITE_BATCH_WINDOW,
+    max_batch=settings.WRITE_BATCH_MAX,
+    max_queue=settings.WRITE_QUEUE_SIZE,
+)
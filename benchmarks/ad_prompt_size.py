@@ -0,0 +1,73 @@
+"""
+Размер рекламной инструкции в промпте: все разрешенные товары vs top-K по релевантности.
+
+Запуск из корня проекта:
+    python benchmarks/ad_prompt_size.py [кол-во_товаров]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+
+# Для импорта app.* достаточно фиктивных ключей: в сеть и БД скрипт не ходит
+for key in ("DATABASE_URL", "OPENROUTER_API_KEY", "GROQ_API_KEY", "TELEGRAM_BOT_TOKEN"):
+    os.environ.setdefault(key, "sqlite+aiosqlite:///:memory:" if key == "DATABASE_URL" else "x")
+
+from app.catalog import CatalogProduct
+from app.config import settings
+from app.relevance import RelevanceIndex, build_query
+from app.services import format_products_prompt
+
+TOPICS = [
+    ("спина, боль, поясница, осанка", "Ортопедический корсет для спины", "Поддерживает поясницу и снимает боль"),
+    ("сон, бессонница, подушка", "Анатомическая подушка", "Крепкий сон без боли в шее"),
+    ("тренировка, мышцы, гантели", "Разборные гантели", "Тренировки дома без абонемента"),
+    ("питание, белок, протеин", "Сывороточный протеин", "Белок для восстановления мышц"),
+    ("витамины, иммунитет, простуда", "Комплекс витаминов", "Поддержка иммунитета зимой"),
+    ("кожа, уход, крем", "Увлажняющий крем", "Уход за сухой кожей"),
+    ("стресс, тревога, медитация", "Курс медитаций", "Снижает тревогу за 10 минут в день"),
+    ("зрение, глаза, экран", "Капли для глаз", "Помогают глазам при работе за экраном"),
+]
+
+QUERIES = [
+    ("Уже неделю болит спина и поясница после работы", []),
+    ("Посоветуй, как быстрее заснуть", []),
+    ("Какие упражнения с гантелями сделать на мышцы рук?", []),
+    ("Расскажи анекдот", []),
+]
+
+def make_catalog(n: int) -> list[CatalogProduct]:
+    rnd = random.Random(42)
+    products = []
+    for i in range(1, n + 1):
+        keywords, name, ad_text = rnd.choice(TOPICS)
+        products.append(CatalogProduct(
+            id=i,
+            name=f"{name} №{i}",
+            keywords=keywords,
+            ad_text=ad_text,
+            link=f"https://partner.example/{i}",
+        ))
+    return products
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    products = make_catalog(n)
+    index = RelevanceIndex(products)
+
+    full_prompt = format_products_prompt(products, user_id=123456789)
+    print(f"Товаров в каталоге: {n}")
+    print(f"Все товары в промпте: {len(full_prompt)} символов")
+    print(f"Top-{settings.AD_TOP_K}, порог {settings.AD_MIN_SCORE}:")
+
+    for text, history in QUERIES:
+        started = time.perf_counter()
+        top = index.top_k(build_query(text, history), products, settings.AD_TOP_K, settings.AD_MIN_SCORE)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        size = len(format_products_prompt(top, user_id=123456789)) if top else 0
+        print(f"  {text[:45]:<45} -> {len(top)} товаров, {size} символов, ранжирование {elapsed_ms:.2f} мс")
+
+if __name__ == "__main__":
+    main()
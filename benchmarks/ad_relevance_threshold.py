@@ -0,0 +1,77 @@
+"""
+Порог релевантности рекламы (AD_MIN_SCORE) на краевых каталогах.
+
+Сырой BM25 масштабируется idf: в каталоге из одного товара и для ключевого
+слова, которое есть почти у всех товаров, idf близок к нулю, и порог по нему
+отсекал бы даже точное совпадение. Скрипт проверяет, что порог применяется
+к совпадению, не зависящему от idf:
+  - каталог из одного товара: "болит спина" находит корсет;
+  - общее ключевое слово у всех товаров: товары находятся, а без совпадений — нет;
+  - обычный каталог: ранжирование по BM25 и отсечение нерелевантного.
+Печатает score и match каждого случая. Завершается с ошибкой, если ожидание не выполнено.
+
+Запуск из корня проекта:
+    python benchmarks/ad_relevance_threshold.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+
+# Для импорта app.* достаточно фиктивных ключей: в сеть и БД скрипт не ходит
+for key in ("DATABASE_URL", "OPENROUTER_API_KEY", "GROQ_API_KEY", "TELEGRAM_BOT_TOKEN"):
+    os.environ.setdefault(key, "sqlite+aiosqlite:///:memory:" if key == "DATABASE_URL" else "x")
+
+from app.catalog import CatalogProduct
+from app.config import settings
+from app.history import HistoryEntry
+from app.relevance import RelevanceIndex, build_query
+
+def product(pid: int, keywords: str, name: str, ad_text: str) -> CatalogProduct:
+    return CatalogProduct(id=pid, name=name, keywords=keywords, ad_text=ad_text, link=f"https://partner.example/{pid}")
+
+CORSET = product(1, "спина, боль, поясница, осанка", "Ортопедический корсет", "Поддерживает поясницу")
+PILLOW = product(2, "сон, бессонница, подушка", "Анатомическая подушка", "Крепкий сон без боли в шее")
+DUMBBELLS = product(3, "тренировка, мышцы, гантели", "Разборные гантели", "Тренировки дома без абонемента")
+# У всех товаров аптечного каталога есть ключ "здоровье"
+PHARMACY = [
+    product(10, "здоровье, витамины, иммунитет", "Комплекс витаминов", "Поддержка иммунитета"),
+    product(11, "здоровье, кожа, крем", "Увлажняющий крем", "Уход за сухой кожей"),
+    product(12, "здоровье, глаза, капли", "Капли для глаз", "При работе за экраном"),
+    product(13, "здоровье, сон, мелатонин", "Мелатонин", "Помогает уснуть"),
+]
+
+# (название, каталог, сообщение, история, ожидаемый первый товар, сколько товаров пройдет порог)
+CASES = [
+    ("один товар", [CORSET], "болит спина", [], 1, 1),
+    ("один товар, не про него", [CORSET], "посоветуй фильм", [], None, 0),
+    ("общий ключ", PHARMACY, "как укрепить здоровье", [], 13, 3),
+    ("общий ключ + точный", PHARMACY, "здоровье и сухая кожа", [], 11, 3),
+    ("общий ключ, без совпадений", PHARMACY, "расскажи анекдот", [], None, 0),
+    ("обычный каталог", [CORSET, PILLOW, DUMBBELLS], "после тренировки ноет спина", [], 3, 2),
+    ("только история", [CORSET, PILLOW, DUMBBELLS], "а что еще посоветуешь?",
+     [HistoryEntry(role="user", content="плохой сон, бессонница")], 2, 1),
+    # Слово рекламного текста из истории — слабое совпадение, отсекается
+    ("слабое совпадение", [CORSET, PILLOW, DUMBBELLS], "а что еще посоветуешь?",
+     [HistoryEntry(role="user", content="я сейчас дома")], None, 0),
+]
+
+def main():
+    failed = []
+    print(f"Top-{settings.AD_TOP_K}, порог {settings.AD_MIN_SCORE}\n")
+    for name, products, text, history, first, count in CASES:
+        index = RelevanceIndex(products)
+        query = build_query(text, history)
+        scores, matches = index.score_and_match(query)
+        top = [p.id for p in index.top_k(query, products, settings.AD_TOP_K, settings.AD_MIN_SCORE)]
+        ok = len(top) == count and (top[0] if top else None) == first
+        details = ", ".join(f"{pid}: score {scores[pid]:.3f} match {matches[pid]:.3f}" for pid in sorted(scores))
+        verdict = "OK" if ok else f"ожидалось {count} шт., первый {first}"
+        print(f"{name:<28} {text[:32]:<32} -> {top} {verdict}  ({details or 'нет совпадений'})")
+        if not ok:
+            failed.append(name)
+    if failed:
+        sys.exit(f"Порог отработал не так, как ожидалось: {', '.join(failed)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Нагрузочный тест: сколько соединений пула занимает /api/chat, пока ИИ отвечает.
+
+Создает временную SQLite-базу и гоняет параллельные запросы через ASGI
+с подставным клиентом ИИ, который "думает" заданное время.
+Сравнивает два варианта:
+  - прежний: сессия запроса (Depends(get_db)) открыта от чтения пользователя
+    до сохранения ответа, то есть и на все время запроса к ИИ;
+  - текущий /api/chat: короткое чтение, ответ ИИ без соединения, запись
+    через общего писателя с групповым коммитом (app/writes.py).
+Каждые 5 мс снимает checkedout() пулов (пишущего и читающего) и печатает пик и среднее,
+а также задержки запросов. Завершается с ошибкой, если текущий вариант
+держит соединений не меньше прежнего.
+
+Запуск из корня проекта:
+    python benchmarks/chat_pool_load.py [пользователей] [секунд_на_ответ_ИИ] [сообщений_на_пользователя]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "pool.db")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{DB_PATH}"
+os.environ["SALEBOT_API_KEY"] = ""
+for key in ("OPENROUTER_API_KEY", "GROQ_API_KEY", "TELEGRAM_BOT_TOKEN"):
+    os.environ.setdefault(key, "x")
+
+import httpx
+from fastapi import Depends, Form
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+import app.services as services
+from app.database import engine, read_engine, Base, get_db
+from app.models import User, Assistant, Message, get_current_time
+from app.counters import increment_user_messages
+from app.history import conversation_cache
+from app.catalog import product_catalog
+from app.registry import assistant_registry
+from app.main import app
+
+USER_ID = 12346  # /api/chat пока работает с тестовым пользователем
+SLUG = "medic"
+
+def fake_llm(delay: float):
+    async def create(**kwargs):
+        await asyncio.sleep(delay)
+        message = types.SimpleNamespace(content="ответ")
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+    return create
+
+@app.post("/bench/legacy-chat")
+async def legacy_chat(assistant_slug: str = Form(...), text: str = Form(...), db: AsyncSession = Depends(get_db)):
+    """Прежняя форма обработчика: одна сессия на весь запрос, включая ответ ИИ."""
+    await db.get(User, USER_ID)
+    history = await conversation_cache.get(db, USER_ID, assistant_slug)
+    ai_answer = await services.get_ai_response(text, assistant_slug, history, user_id=USER_ID)
+    db.add_all([
+        Message(user_id=USER_ID, assistant_slug=assistant_slug, role="user", content=text),
+        Message(user_id=USER_ID, assistant_slug=assistant_slug, role="assistant", content=ai_answer),
+    ])
+    await db.execute(increment_user_messages(USER_ID, get_current_time()))
+    await db.commit()
+    return {"response": ai_answer}
+
+class PoolSampler:
+    def __init__(self):
+        self.samples: list[int] = []
+        self._task: asyncio.Task | None = None
+
+    async def _run(self):
+        while True:
+            # Чтение идет через отдельный пул (app/database.py) — считаем оба
+            checked_out = engine.pool.checkedout()
+            if read_engine is not engine:
+                checked_out += read_engine.pool.checkedout()
+            self.samples.append(checked_out)
+            await asyncio.sleep(0.005)
+
+    def __enter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+
+async def seed():
+    engine.echo = read_engine.echo = False
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(insert(User.__table__), [{"tg_id": USER_ID, "username": "load"}])
+        await conn.execute(insert(Assistant.__table__), [{"slug": SLUG, "name": SLUG, "is_active": True}])
+    # Кэши прогреваются так же, как в lifespan приложения
+    await product_catalog.ensure_loaded()
+    await assistant_registry.ensure_loaded()
+
+async def load(client: httpx.AsyncClient, path: str, users: int, rounds: int) -> dict:
+    latencies: list[float] = []
+
+    async def user_session(n: int):
+        for i in range(rounds):
+            started = time.perf_counter()
+            response = await client.post(path, data={"assistant_slug": SLUG, "text": f"вопрос {n}-{i}"})
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - started)
+
+    with PoolSampler() as sampler:
+        started = time.perf_counter()
+        await asyncio.gather(*(user_session(n) for n in range(users)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "peak": max(sampler.samples),
+        "mean": statistics.mean(sampler.samples),
+        "p50": latencies[len(latencies) // 2] * 1000,
+        "p95": latencies[int(len(latencies) * 0.95)] * 1000,
+        "rps": len(latencies) / elapsed,
+    }
+
+async def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+
+    await seed()
+    services.ai_client.chat.completions.create = fake_llm(delay)
+    pool = engine.pool
+    print(f"пул: {pool.size()} + {pool._max_overflow} overflow; {users} пользователей x {rounds} сообщений, ИИ отвечает {delay} с\n")
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+        results = {}
+        for label, path in (("прежний (сессия на запрос)", "/bench/legacy-chat"), ("короткие фазы (/api/chat)", "/api/chat")):
+            result = results[label] = await load(client, path, users, rounds)
+            print(f"{label:<28} соединений: пик {result['peak']:>2}, среднее {result['mean']:>5.2f}   "
+                  f"p50 {result['p50']:>6.0f} мс  p95 {result['p95']:>6.0f} мс  {result['rps']:>6.1f} запр/с")
+
+    before, after = results.values()
+    if after["mean"] >= before["mean"]:
+        sys.exit("Чат держит соединения не меньше прежнего")
+
+if __name__ == "__main__":
+    asyncio.run(main())
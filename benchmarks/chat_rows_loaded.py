@@ -0,0 +1,102 @@
+"""
+Сколько строк читает из БД обработка одного сообщения чата у "тяжелого" пользователя.
+
+Создает временную SQLite-базу, заводит пользователя с большой историей
+и кликами и прогоняет DB-часть /api/chat (prepare_chat + save_messages),
+считая строки всех ORM-запросов. Для сравнения печатает, сколько строк
+тянула прежняя загрузка User (selectin по messages/clicks).
+Завершается с ошибкой, если чат читает больше ожидаемого.
+
+Запуск из корня проекта:
+    python benchmarks/chat_rows_loaded.py [сообщений_у_пользователя]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "rows.db")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{DB_PATH}"
+os.environ["SALEBOT_API_KEY"] = ""
+for key in ("OPENROUTER_API_KEY", "GROQ_API_KEY", "TELEGRAM_BOT_TOKEN"):
+    os.environ.setdefault(key, "x")
+
+from fastapi import BackgroundTasks
+from sqlalchemy import event, insert, select
+from sqlalchemy.orm import Session, selectinload
+from app.config import settings
+from app.database import engine, read_engine, Base, AsyncSessionLocal
+from app.models import User, Assistant, Message, Product, UserClick
+from app.main import prepare_chat, save_messages
+
+USER_ID = 777
+SLUG = "medic"
+
+class RowCounter:
+    """Считает строки, которые вернули ORM-запросы (в т.ч. selectin-догрузки)."""
+
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+
+    def __call__(self, state):
+        if not state.is_select:
+            return None
+        frozen = state.invoke_statement().freeze()
+        self.statements += 1
+        self.rows += len(frozen.data)
+        return frozen()
+
+async def seed(messages: int):
+    engine.echo = read_engine.echo = False
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(insert(User.__table__), [{"tg_id": USER_ID, "username": "heavy"}])
+        await conn.execute(insert(Assistant.__table__), [{"slug": SLUG, "name": SLUG, "is_active": True}])
+        await conn.execute(insert(Product.__table__), [{"id": 1, "name": "p", "link": "https://ex.com", "is_active": True, "impressions": 0, "clicks": 0}])
+        await conn.execute(insert(Message.__table__), [
+            {"user_id": USER_ID, "assistant_slug": SLUG, "role": "user" if i % 2 == 0 else "assistant", "content": f"сообщение {i}"}
+            for i in range(messages)
+        ])
+        await conn.execute(insert(UserClick.__table__), [{"user_id": USER_ID, "product_id": 1} for _ in range(messages // 10)])
+
+async def measure(label: str, work) -> RowCounter:
+    counter = RowCounter()
+    event.listen(Session, "do_orm_execute", counter)
+    try:
+        started = time.perf_counter()
+        await work()
+        elapsed = (time.perf_counter() - started) * 1000
+    finally:
+        event.remove(Session, "do_orm_execute", counter)
+    print(f"{label:<36} запросов: {counter.statements:>2}  строк: {counter.rows:>6}  {elapsed:>7.1f} мс")
+    return counter
+
+async def legacy_user_load():
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            select(User).where(User.tg_id == USER_ID).options(selectinload(User.messages), selectinload(User.clicks))
+        )
+
+async def chat_turn():
+    _, image, history = await prepare_chat(BackgroundTasks(), {"id": USER_ID, "username": "heavy"}, SLUG, None)
+    await save_messages(USER_ID, SLUG, "привет", image, "ответ")
+
+async def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    await seed(messages)
+    print(f"у пользователя {messages} сообщений и {messages // 10} кликов\n")
+
+    await measure("прежняя загрузка User", legacy_user_load)
+    first = await measure("чат: первое сообщение (промах кэша)", chat_turn)
+    second = await measure("чат: следующее сообщение", chat_turn)
+
+    # Пользователь (1 строка) + окно истории при промахе; дальше — только пользователь
+    if first.rows > 1 + settings.CHAT_HISTORY_LIMIT or second.rows > 1:
+        sys.exit("Чат читает больше строк, чем ожидалось")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,113 @@
+"""
+План и скорость запросов истории диалога: индекс (user_id, assistant_slug, id)
+и курсорная пагинация (before_id) против OFFSET.
+
+Создает временную SQLite-базу по текущим моделям, заполняет messages
+и печатает EXPLAIN QUERY PLAN для запросов окна чата и /api/history.
+Завершается с ошибкой, если какой-то из них не использует индекс.
+
+Запуск из корня проекта:
+    python benchmarks/history_query_plan.py [сообщений_в_диалоге]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+
+for key in ("DATABASE_URL", "OPENROUTER_API_KEY", "GROQ_API_KEY", "TELEGRAM_BOT_TOKEN"):
+    os.environ.setdefault(key, "sqlite+aiosqlite:///:memory:" if key == "DATABASE_URL" else "x")
+
+from sqlalchemy import create_engine, select, text, insert
+from app.database import Base
+from app.models import Message, User, Assistant
+
+INDEX_NAME = "ix_messages_user_assistant_id"
+USERS = 200
+ASSISTANTS = ("medic", "fitness", "agro")
+PAGE = 20
+
+def history_query(user_id: int, slug: str, before_id: int | None = None, offset: int = 0):
+    query = (
+        select(Message.id, Message.role, Message.content, Message.image_path)
+        .where(Message.user_id == user_id, Message.assistant_slug == slug)
+        .order_by(Message.id.desc())
+        .limit(PAGE)
+    )
+    if before_id is not None:
+        query = query.where(Message.id < before_id)
+    elif offset:
+        query = query.offset(offset)
+    return query
+
+def window_query(user_id: int, slug: str):
+    """Тот же запрос, что делает ConversationCache при промахе."""
+    return (
+        select(Message.id, Message.role, Message.content)
+        .where(Message.user_id == user_id, Message.assistant_slug == slug)
+        .order_by(Message.id.desc())
+        .limit(10)
+    )
+
+def seed(engine, per_conversation: int):
+    rows = []
+    conversations = [(uid, slug) for uid in range(1, USERS + 1) for slug in ASSISTANTS]
+    # Перемешиваем, чтобы сообщения одного диалога были разбросаны по таблице, как в жизни
+    order = [conv for conv in conversations for _ in range(per_conversation)]
+    random.Random(1).shuffle(order)
+    for i, (uid, slug) in enumerate(order):
+        rows.append({"user_id": uid, "assistant_slug": slug, "role": "user" if i % 2 else "assistant", "content": f"сообщение {i}"})
+
+    with engine.begin() as conn:
+        conn.execute(insert(User.__table__), [{"tg_id": uid, "username": f"u{uid}"} for uid in range(1, USERS + 1)])
+        conn.execute(insert(Assistant.__table__), [{"slug": slug, "name": slug, "is_active": True} for slug in ASSISTANTS])
+        conn.execute(insert(Message.__table__), rows)
+        conn.execute(text("ANALYZE"))
+    return len(rows)
+
+def explain(conn, query) -> str:
+    compiled = query.compile(conn, compile_kwargs={"literal_binds": True})
+    plan = conn.execute(text(f"EXPLAIN QUERY PLAN {compiled}")).all()
+    return "; ".join(row[-1] for row in plan)
+
+def timed(conn, query, repeats: int = 50) -> float:
+    started = time.perf_counter()
+    for _ in range(repeats):
+        conn.execute(query).all()
+    return (time.perf_counter() - started) / repeats * 1000
+
+def main():
+    per_conversation = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    path = os.path.join(tempfile.mkdtemp(), "history.db")
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    total = seed(engine, per_conversation)
+    print(f"messages: {total}, в одном диалоге: {per_conversation}\n")
+
+    failed = False
+    with engine.connect() as conn:
+        deep_offset = per_conversation - PAGE * 2
+        last_id = conn.execute(
+            select(Message.id).where(Message.user_id == 7, Message.assistant_slug == "medic")
+            .order_by(Message.id).offset(PAGE).limit(1)
+        ).scalar()
+
+        cases = [
+            ("окно чата", window_query(7, "medic")),
+            ("первая страница", history_query(7, "medic")),
+            ("курсор before_id", history_query(7, "medic", before_id=last_id)),
+            (f"offset={deep_offset}", history_query(7, "medic", offset=deep_offset)),
+        ]
+        for label, query in cases:
+            plan = explain(conn, query)
+            uses_index = INDEX_NAME in plan and "TEMP B-TREE" not in plan
+            failed |= not uses_index
+            print(f"{label:<20} {timed(conn, query):>7.3f} мс  {'OK ' if uses_index else 'BAD'} {plan}")
+
+    if failed:
+        sys.exit("Запрос истории не использует индекс " + INDEX_NAME)
+
+if __name__ == "__main__":
+    main()
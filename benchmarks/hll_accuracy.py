@@ -0,0 +1,128 @@
+"""
+Точность и скорость HyperLogLog-скетчей (app/hll.py) на синтетических данных.
+
+1. Точность одного скетча на разных мощностях (несколько прогонов, случайные id).
+2. Точность объединения 30 дневных скетчей с пересекающимися пользователями (MAU).
+3. Скорость MAU в SQLite: COUNT(DISTINCT) по daily_user_activity против
+   чтения и объединения daily_sketches за 30 дней.
+
+Завершается с ошибкой, если какая-то оценка отклонилась больше чем на 4 стандартные ошибки.
+
+Запуск из корня проекта:
+    python benchmarks/hll_accuracy.py [активных_в_день] [всего_пользователей]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+
+for key in ("DATABASE_URL", "OPENROUTER_API_KEY", "GROQ_API_KEY", "TELEGRAM_BOT_TOKEN"):
+    os.environ.setdefault(key, "sqlite+aiosqlite:///:memory:" if key == "DATABASE_URL" else "x")
+
+from sqlalchemy import create_engine, select, func, distinct, insert
+from app.database import Base
+from app.hll import HyperLogLog
+from app.models import DailyUserActivity, DailySketch
+
+CARDINALITIES = (100, 1_000, 10_000, 100_000, 1_000_000)
+TRIALS = 5
+DAYS = 30
+TODAY = date(2026, 1, 31)
+
+def random_ids(rng: random.Random, n: int) -> set[int]:
+    ids = set()
+    while len(ids) < n:
+        ids.add(rng.getrandbits(40))
+    return ids
+
+def single_sketch_accuracy(limit: float) -> bool:
+    print(f"{'мощность':>10} {'ср. ошибка':>11} {'СКО':>7} {'макс':>7} {'add, мкс':>9}")
+    ok = True
+    for n in CARDINALITIES:
+        errors, elapsed = [], 0.0
+        trials = TRIALS if n < 1_000_000 else 2
+        for trial in range(trials):
+            ids = random_ids(random.Random(n * 100 + trial), n)
+            sketch = HyperLogLog()
+            started = time.perf_counter()
+            sketch.update(ids)
+            elapsed += time.perf_counter() - started
+            errors.append(sketch.count() / n - 1)
+        rms = (sum(e * e for e in errors) / len(errors)) ** 0.5
+        worst = max(abs(e) for e in errors)
+        ok &= worst <= limit
+        print(f"{n:>10} {sum(errors) / len(errors) * 100:>10.2f}% {rms * 100:>6.2f}% {worst * 100:>6.2f}% "
+              f"{elapsed / (n * trials) * 1e6:>9.2f}")
+    return ok
+
+def build_days(daily: int, population: int) -> dict[date, list[int]]:
+    """Каждый день активна случайная выборка из общей базы: пользователи пересекаются между днями."""
+    rng = random.Random(7)
+    base = list(random_ids(rng, population))
+    return {TODAY - timedelta(days=i): rng.sample(base, daily) for i in range(DAYS)}
+
+def seed(engine, days: dict[date, list[int]]):
+    with engine.begin() as conn:
+        conn.execute(insert(DailyUserActivity.__table__), [
+            {"day": day, "user_id": user_id, "message_count": 1} for day, user_ids in days.items() for user_id in user_ids
+        ])
+        rows = []
+        for day, user_ids in days.items():
+            sketch = HyperLogLog()
+            sketch.update(user_ids)
+            rows.append({"day": day, "scope": "all", "registers": sketch.to_bytes()})
+        conn.execute(insert(DailySketch.__table__), rows)
+    return sum(len(row["registers"]) for row in rows)
+
+def timed(fn, repeats: int = 10):
+    started = time.perf_counter()
+    for _ in range(repeats):
+        value = fn()
+    return value, (time.perf_counter() - started) / repeats * 1000
+
+def main():
+    daily = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    population = int(sys.argv[2]) if len(sys.argv) > 2 else 200_000
+    limit = 4 * HyperLogLog().relative_error
+
+    print(f"1. Один скетч, стандартная ошибка {HyperLogLog().relative_error * 100:.2f}%\n")
+    ok = single_sketch_accuracy(limit)
+
+    print(f"\n2-3. MAU: {DAYS} дней по {daily} активных из {population} пользователей\n")
+    days = build_days(daily, population)
+    exact_mau = len({user_id for user_ids in days.values() for user_id in user_ids})
+
+    path = os.path.join(tempfile.mkdtemp(), "hll.db")
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine, tables=[DailyUserActivity.__table__, DailySketch.__table__])
+    stored = seed(engine, days)
+    first_day = TODAY - timedelta(days=DAYS - 1)
+
+    with engine.connect() as conn:
+        def exact():
+            return conn.execute(
+                select(func.count(distinct(DailyUserActivity.user_id))).where(DailyUserActivity.day >= first_day)
+            ).scalar()
+
+        def approx():
+            rows = conn.execute(select(DailySketch.registers).where(DailySketch.day >= first_day)).scalars()
+            return HyperLogLog.union(HyperLogLog.from_bytes(registers) for registers in rows).count()
+
+        exact_value, exact_ms = timed(exact)
+        approx_value, approx_ms = timed(approx)
+
+    error = approx_value / exact_mau - 1
+    ok &= exact_value == exact_mau and abs(error) <= limit
+    print(f"{'COUNT(DISTINCT)':<18} {exact_value:>8} {exact_ms:>8.1f} мс  ({DAYS * daily} строк)")
+    print(f"{'HyperLogLog':<18} {approx_value:>8} {approx_ms:>8.1f} мс  ({DAYS} скетчей, {stored // 1024} КБ)")
+    print(f"ошибка MAU: {error * 100:.2f}%, ускорение: x{exact_ms / approx_ms:.1f}")
+
+    if not ok:
+        sys.exit(f"Ошибка оценки больше {limit * 100:.1f}%")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Обработка загруженных картинок: прежний пайплайн (полное декодирование) vs текущий
+(draft-декодирование JPEG + reducing_gap).
+
+Берет картинки из static/uploads и делает из них "телефонные" фото 4032x3024,
+чтобы было видно эффект на больших кадрах.
+
+Запуск из корня проекта:
+    python benchmarks/image_ingest.py [кол-во_повторов]
+"""
+import glob
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+
+for key in ("DATABASE_URL", "OPENROUTER_API_KEY", "GROQ_API_KEY", "TELEGRAM_BOT_TOKEN"):
+    os.environ.setdefault(key, "sqlite+aiosqlite:///:memory:" if key == "DATABASE_URL" else "x")
+
+from PIL import Image
+from app.images import MAX_SIZE, JPEG_QUALITY, DRAFT_TOLERANCE, process_image, write_file
+
+PHONE_SIZE = (4032, 3024)
+
+def legacy_process(content: bytes, output_path: str):
+    """Пайплайн до оптимизации: декодирование в полном разрешении, запись и повторное чтение файла."""
+    image = Image.open(io.BytesIO(content))
+    if image.mode in ("RGBA", "P"):
+        image = image.convert("RGB")
+    image.thumbnail(MAX_SIZE, Image.Resampling.LANCZOS)
+    image.save(output_path, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    with open(output_path, "rb") as f:
+        return f.read()
+
+def current_process(content: bytes, output_path: str):
+    data, _ = process_image(content)
+    write_file(output_path, data)
+    return data
+
+def decoded_megapixels(content: bytes, use_draft: bool) -> float:
+    """Сколько пикселей реально распаковывается в память (пиковый буфер декодера)."""
+    image = Image.open(io.BytesIO(content))
+    scale = min(MAX_SIZE[0] / image.width, MAX_SIZE[1] / image.height)
+    if use_draft and image.format == "JPEG" and scale < 1:
+        image.draft("RGB", (int(image.width * scale * DRAFT_TOLERANCE), int(image.height * scale * DRAFT_TOLERANCE)))
+    image.load()
+    return image.width * image.height / 1e6
+
+def samples():
+    for path in sorted(glob.glob("static/uploads/*")):
+        original = Image.open(path).convert("RGB")
+        name = os.path.basename(path)[:8]
+        buf = io.BytesIO()
+        original.save(buf, "JPEG", quality=90)
+        yield f"{name} {original.width}x{original.height}", buf.getvalue()
+
+        phone = original.resize(PHONE_SIZE, Image.Resampling.BICUBIC)
+        buf = io.BytesIO()
+        phone.save(buf, "JPEG", quality=92)
+        yield f"{name} {PHONE_SIZE[0]}x{PHONE_SIZE[1]}", buf.getvalue()
+
+def bench(fn, content: bytes, output_path: str, repeats: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeats):
+        fn(content, output_path)
+    return (time.perf_counter() - started) / repeats * 1000
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    out = os.path.join(tempfile.mkdtemp(), "out.jpg")
+
+    print(f"{'картинка':<24} {'размер':>8} {'было, мс':>9} {'стало, мс':>10} {'было, Мп':>9} {'стало, Мп':>10}")
+    for label, content in samples():
+        legacy_ms = bench(legacy_process, content, out, repeats)
+        current_ms = bench(current_process, content, out, repeats)
+        print(
+            f"{label:<24} {len(content) // 1024:>6}KB {legacy_ms:>9.1f} {current_ms:>10.1f}"
+            f" {decoded_megapixels(content, False):>9.2f} {decoded_megapixels(content, True):>10.2f}"
+        )
+
+if __name__ == "__main__":
+    main()
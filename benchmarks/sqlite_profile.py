@@ -0,0 +1,203 @@
+"""
+Конкурентная нагрузка на SQLite: профиль "production" (WAL, synchronous=NORMAL,
+mmap, кэш страниц, отдельный пул для чтения) против настроек по умолчанию.
+
+Для каждого профиля (SQLITE_PROFILE, app/database.py) создает временную базу
+с историей переписки и запускает над ней несколько процессов, как воркеры
+uvicorn (настройки движков читаются при импорте, поэтому каждый профиль —
+в своих процессах):
+  - процесс писателей: сохранение сообщения как в save_messages (через app/writes.py);
+  - процессы читателей: страница /api/history через сессию для чтения
+    и дашборд (DashboardMetrics.get_activity, get_message_volume и подсчет
+    строк messages, как в списке сообщений админки).
+Задачи нагрузки делают паузу между операциями, чтобы в задержках было видно
+ожидание блокировок SQLite, а не очередь к процессору.
+Печатает пропускную способность и задержки каждой группы и ошибки
+("database is locked"). Завершается с ошибкой, если профиль "production"
+не быстрее по записи.
+
+Запуск из корня проекта:
+    python benchmarks/sqlite_profile.py [секунд] [писателей] [читателей] [процессов_читателей]
+"""
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__), ".."))
+PROFILES = ("default", "production")
+USERS = 200
+MESSAGES_PER_USER = 1000
+SLUG = "medic"
+# Пауза между операциями одной задачи нагрузки (секунды)
+PAUSE = 0.05
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)] * 1000 if values else 0.0
+
+async def seed():
+    from sqlalchemy import insert
+    from app.database import engine, Base
+    from app.models import User, Message
+    from app.rollups import rollup_job
+
+    engine.echo = False
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(insert(User.__table__), [{"tg_id": uid, "username": f"u{uid}"} for uid in range(1, USERS + 1)])
+        await conn.execute(insert(Message.__table__), [
+            {"user_id": uid, "assistant_slug": SLUG, "role": "user" if n % 2 else "assistant", "content": f"сообщение {n} " * 10}
+            for uid in range(1, USERS + 1) for n in range(MESSAGES_PER_USER)
+        ])
+    await rollup_job.run()
+    return {}
+
+async def workload(role: str, seconds: float, tasks: int) -> dict:
+    """Один процесс нагрузки: role = "write" (писатели) или "read" (читатели истории и дашборд)."""
+    from sqlalchemy import insert, select, func
+    from app.database import engine, read_engine, ReadSessionLocal
+    from app.models import Message, get_current_time
+    from app.counters import increment_user_messages
+    from app.metrics import DashboardMetrics
+    from app.writes import write_coordinator
+
+    engine.echo = read_engine.echo = False
+    stats: dict[str, dict] = {}
+    deadline = time.perf_counter() + seconds
+
+    async def timed(group: str, call):
+        data = stats.setdefault(group, {"latencies": [], "errors": 0})
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                await call()
+            except Exception:
+                data["errors"] += 1
+                continue
+            data["latencies"].append(time.perf_counter() - started)
+            # Темп как у живых пользователей: процессор не загружен полностью,
+            # и в задержках видно ожидание блокировок SQLite, а не очередь к CPU
+            await asyncio.sleep(PAUSE)
+
+    def writer(n: int):
+        async def call():
+            user_id = n % USERS + 1
+            sent_at = get_current_time()
+            rows = [
+                {"user_id": user_id, "assistant_slug": SLUG, "role": role, "content": "новое", "image_path": None, "created_at": sent_at}
+                for role in ("user", "assistant")
+            ]
+
+            async def write(conn):
+                await conn.execute(insert(Message.__table__), rows)
+                await conn.execute(increment_user_messages(user_id, sent_at))
+            await write_coordinator.submit(write)
+        return call
+
+    def history_reader(n: int):
+        async def call():
+            user_id = (n * 37 + int(time.perf_counter() * 1000)) % USERS + 1
+            async with ReadSessionLocal() as db:
+                result = await db.execute(
+                    select(Message.id, Message.role, Message.content, Message.image_path)
+                    .where(Message.user_id == user_id, Message.assistant_slug == SLUG)
+                    .order_by(Message.id.desc())
+                    .limit(20)
+                )
+                result.all()
+        return call
+
+    async def dashboard():
+        async with ReadSessionLocal() as db:
+            metrics = DashboardMetrics(db)
+            await metrics.get_activity()
+            await metrics.get_message_volume()
+            # Список сообщений в админке считает строки всей таблицы — длинное чтение
+            await db.execute(select(func.count(Message.id)))
+
+    started = time.perf_counter()
+    if role == "write":
+        await asyncio.gather(*(timed("write", writer(n)) for n in range(tasks)))
+        await write_coordinator.stop()
+    else:
+        await asyncio.gather(*(timed("history", history_reader(n)) for n in range(tasks)), timed("dashboard", dashboard))
+    elapsed = time.perf_counter() - started
+
+    return {
+        group: {
+            "rate": len(data["latencies"]) / elapsed,
+            "latencies": data["latencies"],
+            "errors": data["errors"],
+        }
+        for group, data in stats.items()
+    }
+
+def run_profile(profile: str, directory: str, seconds: str, writers: str, readers: str, read_processes: int) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "SQLITE_PROFILE": profile,
+        "DATABASE_URL": f"sqlite+aiosqlite:///{os.path.join(directory, 'profile.db')}",
+        "SALEBOT_API_KEY": "",
+    })
+    for key in ("OPENROUTER_API_KEY", "GROQ_API_KEY", "TELEGRAM_BOT_TOKEN"):
+        env.setdefault(key, "x")
+
+    def spawn(*args: str) -> subprocess.Popen:
+        return subprocess.Popen([sys.executable, __file__, "--worker", *args], env=env, cwd=ROOT, stdout=subprocess.PIPE, text=True)
+
+    def result(process: subprocess.Popen) -> dict:
+        output, _ = process.communicate()
+        if process.returncode:
+            sys.exit(f"Процесс нагрузки ({profile}) завершился с кодом {process.returncode}")
+        return json.loads(output.strip().splitlines()[-1])
+
+    result(spawn("seed", "0", "0"))
+    # Как несколько воркеров uvicorn: писатель и читатели — разные процессы над одним файлом
+    processes = [spawn("write", seconds, writers)] + [spawn("read", seconds, readers) for _ in range(read_processes)]
+    merged: dict[str, dict] = {}
+    for process in processes:
+        for group, r in result(process).items():
+            total = merged.setdefault(group, {"rate": 0.0, "latencies": [], "errors": 0})
+            total["rate"] += r["rate"]
+            total["latencies"] += r["latencies"]
+            total["errors"] += r["errors"]
+    return merged
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] == "--worker":
+        sys.path.insert(0, ROOT)
+        role, seconds, tasks = args[1], float(args[2]), int(args[3])
+        result = asyncio.run(seed() if role == "seed" else workload(role, seconds, tasks))
+        print(json.dumps(result))
+        return
+
+    seconds = args[0] if len(args) > 0 else "10"
+    writers = args[1] if len(args) > 1 else "10"
+    readers = args[2] if len(args) > 2 else "5"
+    read_processes = int(args[3]) if len(args) > 3 else 2
+    print(f"{USERS} пользователей x {MESSAGES_PER_USER} сообщений; {seconds} с: процесс с {writers} писателями, "
+          f"{read_processes} процесса по {readers} читателей истории и дашборду\n")
+
+    results = {}
+    for profile in PROFILES:
+        with tempfile.TemporaryDirectory() as directory:
+            results[profile] = run_profile(profile, directory, seconds, writers, readers, read_processes)
+        for group, r in results[profile].items():
+            print(f"{profile:<11} {group:<10} {r['rate']:>8.1f} оп/с  p50 {percentile(r['latencies'], 0.5):>7.1f} мс  "
+                  f"p95 {percentile(r['latencies'], 0.95):>7.1f} мс  ошибок: {r['errors']}")
+        print()
+
+    def speedup(group: str) -> float:
+        return results["production"][group]["rate"] / max(results["default"][group]["rate"], 1e-9)
+
+    print(f"production / default: запись x{speedup('write'):.1f}, история x{speedup('history'):.1f}, дашборд x{speedup('dashboard'):.1f}")
+    if speedup("write") <= 1:
+        sys.exit("Профиль production не быстрее настроек по умолчанию по записи")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Пропускная способность записи в SQLite: транзакция на каждый запрос
+против общего писателя с групповым коммитом (app/writes.py).
+
+Создает временную SQLite-базу и запускает параллельных "пользователей",
+каждый из которых сохраняет сообщения так же, как save_messages:
+INSERT двух сообщений + UPDATE счетчиков пользователя. Печатает записей
+в секунду, число коммитов, ошибки ("database is locked") и задержки.
+Завершается с ошибкой, если групповой коммит не быстрее.
+
+Запуск из корня проекта:
+    python benchmarks/write_throughput.py [пользователей] [записей_на_пользователя]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "writes.db")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{DB_PATH}"
+for key in ("OPENROUTER_API_KEY", "GROQ_API_KEY", "TELEGRAM_BOT_TOKEN"):
+    os.environ.setdefault(key, "x")
+
+from sqlalchemy import insert, select, func
+from app.database import engine, Base
+from app.models import User, Message, get_current_time
+from app.counters import increment_user_messages
+from app.writes import write_coordinator
+
+def chat_write(user_id: int, n: int):
+    """То же, что пишет save_messages за одно сообщение чата."""
+    sent_at = get_current_time()
+    rows = [
+        {"user_id": user_id, "assistant_slug": "medic", "role": role, "content": f"{role} {n}", "image_path": None, "created_at": sent_at}
+        for role in ("user", "assistant")
+    ]
+
+    async def write(conn):
+        await conn.execute(insert(Message.__table__), rows)
+        await conn.execute(increment_user_messages(user_id, sent_at))
+    return write
+
+async def direct(work):
+    async with engine.begin() as conn:
+        await work(conn)
+
+async def grouped(work):
+    await write_coordinator.submit(work)
+
+async def run(label: str, write, users: int, per_user: int):
+    latencies: list[float] = []
+    errors = 0
+    batches_before = write_coordinator.batches
+
+    async def user(user_id: int):
+        nonlocal errors
+        for n in range(per_user):
+            started = time.perf_counter()
+            try:
+                await write(chat_write(user_id, n))
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(uid) for uid in range(1, users + 1)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    commits = write_coordinator.batches - batches_before if write is grouped else len(latencies)
+    rate = len(latencies) / elapsed
+    p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0
+    print(f"{label:<22} {rate:>8.0f} записей/с  коммитов: {commits:>5}  ошибок: {errors:>4}  "
+          f"p50 {p50:>6.1f} мс  p95 {p95:>6.1f} мс")
+    return rate
+
+async def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    engine.echo = False
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(insert(User.__table__), [{"tg_id": uid, "username": f"u{uid}"} for uid in range(1, users + 1)])
+    print(f"{users} параллельных пользователей x {per_user} сохранений (2 INSERT + 1 UPDATE)\n")
+
+    direct_rate = await run("транзакция на запрос", direct, users, per_user)
+    grouped_rate = await run("групповой коммит", grouped, users, per_user)
+    await write_coordinator.stop()
+
+    async with engine.connect() as conn:
+        messages = (await conn.execute(select(func.count(Message.id)))).scalar()
+        counted = (await conn.execute(select(func.sum(User.total_messages)))).scalar()
+    print(f"\nсообщений в БД: {messages}, users.total_messages: {counted}; ускорение x{grouped_rate / direct_rate:.1f}")
+
+    if grouped_rate <= direct_rate:
+        sys.exit("Групповой коммит не быстрее транзакции на запрос")
+
+if __name__ == "__main__":
+    asyncio.run(main())